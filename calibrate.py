@@ -0,0 +1,143 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+calibration_name = "fake.calibration.json"
+
+
+def fit_cost(sizes, walls):
+    """Fit the wall time of DOLPHOT runs as startup + per star cost
+
+    Args:
+        sizes (list): number of fake stars of each run
+        walls (list): wall time of each run in seconds
+
+    Returns:
+        startup (float): fixed cost of a run in seconds
+        per_star (float): cost of a fake star in seconds
+    """
+    sizes = np.asarray(sizes, dtype=np.float64)
+    walls = np.asarray(walls, dtype=np.float64)
+    if len(np.unique(sizes)) < 2:
+        return float(walls.mean()), 0.0
+    per_star, startup = np.polyfit(sizes, walls, 1)
+    per_star = max(per_star, 0.0)
+    startup = max(float(np.mean(walls - per_star * sizes)), 0.0)
+    return startup, float(per_star)
+
+
+def campaign_time(stars, run, workers, startup, per_star):
+    """Wall time of running stars fake stars in runs on workers processes
+
+    Args:
+        stars (int): number of fake stars
+        run (int or array): number of fake stars per run
+        workers (int): number of processes
+        startup (float): fixed cost of a run in seconds
+        per_star (float): cost of a fake star in seconds
+
+    Returns:
+        wall (float or array): wall time in seconds
+    """
+    runs = -(-stars // run)
+    rounds = -(-runs // workers)
+    return rounds * (startup + per_star * run)
+
+
+def choose_run(stars, workers, startup, per_star, max_run):
+    """Run size with the shortest campaign
+
+    Larger runs pay the startup fewer times, but too few of them leave
+    workers idle, so every size up to max_run is tried.
+
+    Args:
+        stars (int): number of fake stars
+        workers (int): number of processes
+        startup (float): fixed cost of a run in seconds
+        per_star (float): cost of a fake star in seconds
+        max_run (int): largest run allowed by the crowding
+
+    Returns:
+        run (int): number of fake stars per run
+        wall (float): wall time in seconds
+    """
+    run = np.arange(1, max(1, min(max_run, stars)) + 1)
+    wall = campaign_time(stars, run, workers, startup, per_star)
+    best = int(np.argmin(wall))
+    return int(run[best]), float(wall[best])
+
+
+def memory_available():
+    """Memory available for new processes
+
+    Returns:
+        memory (int): bytes, None if unknown
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def choose_workers(cores, memory, rss):
+    """Number of processes which fit in the cores and the memory
+
+    Args:
+        cores (int): number of cores
+        memory (int): memory budget in bytes, None for no limit
+        rss (int): peak RSS of a process in bytes
+
+    Returns:
+        workers (int): number of processes
+    """
+    if memory is None or rss <= 0:
+        return max(1, cores)
+    return max(1, min(cores, int(memory // rss)))
+
+
+def param_hash(param_name):
+    """Hash of a parameter file
+
+    Args:
+        param_name (string): parameter file
+
+    Returns:
+        digest (string): sha1 of the content
+    """
+    with open(param_name, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_calibration(file_name=calibration_name):
+    """Read the recorded calibration
+
+    Args:
+        file_name (string): calibration file
+                            (fake.calibration.json)
+
+    Returns:
+        calibration (dictionary): chip -> model, empty if none is recorded
+    """
+    if not os.path.exists(file_name):
+        return dict()
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def save_calibration(calibration, file_name=calibration_name):
+    """Record the calibration
+
+    Args:
+        calibration (dictionary): chip -> model
+        file_name (string): calibration file
+                            (fake.calibration.json)
+    """
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(calibration, f, indent=1)
+    os.replace(file_name + ".tmp", file_name)
@@ -0,0 +1,410 @@
+import os
+import json
+import shutil
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from astropy.io import fits
+from astropy.table import Table
+
+global_columns = OrderedDict([("X", 2), ("Y", 3), ("OBJECT_TYPE", 10)])
+filter_columns = OrderedDict(
+    [
+        ("_VEGA", 15),
+        ("_ERR", 17),
+        ("_SNR", 19),
+        ("_SHARP", 20),
+        ("_ROUND", 21),
+        ("_CROWD", 22),
+        ("_FLAG", 23),
+    ]
+)
+
+# compact schema: float64 only where the precision is needed
+position_columns = ["X", "Y", "RA", "DEC"]
+integer_columns = ["chip", "OBJECT_TYPE"]
+
+
+def column_dtype(name):
+    """Dtype of a catalog column
+
+    Positions are float64, the fake star ID is int64, the chip, the object
+    type and the flags are int8, and the photometric quantities, which
+    DOLPHOT writes with 3 decimals, are float32.
+
+    Args:
+        name (string): column name
+
+    Returns:
+        dtype (dtype): column dtype
+    """
+    if name in position_columns:
+        return np.dtype(np.float64)
+    if name == "ID":
+        return np.dtype(np.int64)
+    if name in integer_columns or name.endswith("_FLAG"):
+        return np.dtype(np.int8)
+    return np.dtype(np.float32)
+
+
+def read_filters(columns_name):
+    """Read the filters from output.columns
+
+    Args:
+        columns_name (string): columns file
+
+    Returns:
+        filters (list): filter names
+        filters_index (list): first column of each filter
+    """
+    df_column = pd.read_csv(columns_name, names=["column"], sep="\t")
+    filters = []
+    for i in range(int((len(df_column) - 11) / 13)):
+        column = df_column.iloc[11 + 13 * i]["column"]
+        if "(" in column:
+            column_filter = column.split("(")[1].split(",")[0]  # ACS
+        else:
+            column_filter = column.split(",")[1].strip()  # WFC3
+        if column_filter not in filters:
+            filters.append(column_filter)
+
+    filters_index = list()
+    for filter_name in filters:
+        for i in range(len(df_column)):
+            if filter_name in df_column.iloc[i].column:
+                filters_index.append(i)
+                break
+    return filters, filters_index
+
+
+def phot_columns(filters, filters_index, offset=0, labels=global_columns):
+    """Columns of the DOLPHOT output used in the catalog
+
+    Args:
+        filters (list): filter names
+        filters_index (list): first column of each filter
+        offset (int): number of leading columns, e.g. the fake star input
+                      (0)
+        labels (dictionary): global columns to include
+                             (global_columns)
+
+    Returns:
+        columns (OrderedDict): column name -> column index
+    """
+    columns = OrderedDict((k, v + offset) for k, v in labels.items())
+    for filter_name, filter_index in zip(filters, filters_index):
+        for label, index in filter_columns.items():
+            columns[filter_name + label] = index + filter_index - 11 + offset
+    return columns
+
+
+def read_output(data_name, columns, chunksize=1000000):
+    """Read the selected columns of a DOLPHOT output
+
+    Only the selected columns are tokenized, by the C parser of pandas,
+    and the file is read in chunks so the other columns are never held
+    in memory.
+
+    Args:
+        data_name (string): DOLPHOT output
+        columns (dictionary): column name -> column index
+        chunksize (int): number of rows per chunk
+                         (1000000)
+
+    Returns:
+        data (dictionary): column name -> array
+    """
+    chunks = list(iter_output(data_name, columns, chunksize))
+    if not chunks:
+        return {name: np.zeros(0, column_dtype(name)) for name in columns}
+    return {name: np.concatenate([j[name] for j in chunks]) for name in columns}
+
+
+def iter_output(data_name, columns, chunksize=1000000, dtype=None):
+    """Iterate over the selected columns of a DOLPHOT output in chunks
+
+    The columns are parsed straight into their column_dtype.
+
+    Args:
+        data_name (string): DOLPHOT output
+        columns (dictionary): column name -> column index
+        chunksize (int): number of rows per chunk
+                         (1000000)
+        dtype (dtype): dtype of all the columns instead of column_dtype
+                       (None)
+
+    Yields:
+        data (dictionary): column name -> array
+    """
+    try:
+        reader = pd.read_csv(
+            data_name,
+            sep=r"\s+",
+            header=None,
+            usecols=sorted(set(columns.values())),
+            dtype={
+                index: column_dtype(name) if dtype is None else dtype
+                for name, index in columns.items()
+            },
+            engine="c",
+            chunksize=chunksize,
+        )
+    except pd.errors.EmptyDataError:
+        return
+    with reader:
+        for frame in reader:
+            yield {name: frame[index].to_numpy() for name, index in columns.items()}
+
+
+cache_version = 2
+
+
+def cache_dir(data_name):
+    """Cache folder of a DOLPHOT output
+
+    Args:
+        data_name (string): DOLPHOT output
+
+    Returns:
+        folder (string): cache folder
+    """
+    dirname, basename = os.path.split(data_name)
+    return os.path.join(dirname, ".dolcache", basename)
+
+
+def read_cache_meta(data_name):
+    """Read the meta of the cache of a DOLPHOT output
+
+    Args:
+        data_name (string): DOLPHOT output
+
+    Returns:
+        meta (dictionary): meta, None if the output is not cached
+    """
+    meta_name = os.path.join(cache_dir(data_name), "meta.json")
+    if not os.path.exists(meta_name):
+        return None
+    with open(meta_name) as f:
+        return json.load(f)
+
+
+def write_cache_meta(data_name, meta):
+    """Save the meta of the cache of a DOLPHOT output
+
+    Args:
+        data_name (string): DOLPHOT output
+        meta (dictionary): meta
+    """
+    meta_name = os.path.join(cache_dir(data_name), "meta.json")
+    with open(meta_name + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_name + ".tmp", meta_name)
+
+
+def count_rows(data_name):
+    """Count the rows of a text file
+
+    Args:
+        data_name (string): text file
+
+    Returns:
+        rows (int): number of rows
+    """
+    rows = 0
+    last = b"\n"
+    with open(data_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            rows += block.count(b"\n")
+            last = block[-1:]
+    return rows + (last != b"\n")
+
+
+def open_output(data_name, columns, chunksize=1000000):
+    """Open the selected columns of a DOLPHOT output through the cache
+
+    Each column is converted once into a .npy file in cache_dir and then
+    memory mapped. The cache is keyed by the size and mtime of the output
+    and only the columns missing from it, or cached with another dtype,
+    are parsed. If the output cannot be parsed, the files written for it
+    are removed.
+
+    Args:
+        data_name (string): DOLPHOT output
+        columns (dictionary): column name -> column index
+        chunksize (int): number of rows per chunk when parsing
+                         (1000000)
+
+    Returns:
+        data (dictionary): column name -> read-only memory-mapped array
+    """
+    folder = cache_dir(data_name)
+    meta_name = os.path.join(folder, "meta.json")
+    stat = os.stat(data_name)
+    source = [stat.st_size, stat.st_mtime_ns]
+    meta = read_cache_meta(data_name)
+    if meta is not None:
+        if meta["source"] != source or meta.get("version") != cache_version:
+            shutil.rmtree(folder)
+            meta = None
+    if meta is None:
+        os.makedirs(folder, exist_ok=True)
+        meta = {
+            "version": cache_version,
+            "source": source,
+            "rows": count_rows(data_name),
+            "columns": {},
+        }
+
+    missing = OrderedDict()
+    for label, index in columns.items():
+        name = "c{0:d}".format(index)
+        if meta["columns"].get(name) != column_dtype(label).str:
+            missing[label] = index
+    if missing and meta["rows"] > 0:
+        arrays = {
+            label: np.lib.format.open_memmap(
+                os.path.join(folder, "c{0:d}.npy.tmp".format(index)),
+                mode="w+",
+                dtype=column_dtype(label),
+                shape=(meta["rows"],),
+            )
+            for label, index in missing.items()
+        }
+        try:
+            start = 0
+            for chunk in iter_output(data_name, missing, chunksize):
+                end = start + len(chunk[next(iter(missing))])
+                for label in missing:
+                    arrays[label][start:end] = chunk[label]
+                start = end
+            if start != meta["rows"]:
+                raise IOError(
+                    "Read {0:d} rows from {1} instead of {2:d}".format(
+                        start, data_name, meta["rows"]
+                    )
+                )
+        except Exception:
+            # leave no partial cache behind an output which cannot be read
+            arrays.clear()
+            if os.path.exists(meta_name):
+                for index in missing.values():
+                    temp_name = os.path.join(folder, "c{0:d}.npy.tmp".format(index))
+                    if os.path.exists(temp_name):
+                        os.remove(temp_name)
+            else:
+                shutil.rmtree(folder, ignore_errors=True)
+                try:
+                    os.rmdir(os.path.dirname(folder))
+                except OSError:
+                    pass
+            raise
+        for label, index in missing.items():
+            arrays[label].flush()
+            del arrays[label]
+            os.replace(
+                os.path.join(folder, "c{0:d}.npy.tmp".format(index)),
+                os.path.join(folder, "c{0:d}.npy".format(index)),
+            )
+    if missing:
+        for label, index in missing.items():
+            meta["columns"]["c{0:d}".format(index)] = column_dtype(label).str
+        write_cache_meta(data_name, meta)
+
+    if meta["rows"] == 0:
+        return {name: np.zeros(0, column_dtype(name)) for name in columns}
+    return {
+        name: np.load(os.path.join(folder, "c{0:d}.npy".format(index)), mmap_mode="r")
+        for name, index in columns.items()
+    }
+
+
+def write_fits(t, file_name):
+    """Write a table to FITS, with the int8 columns saved as int16
+
+    astropy would save int8 columns as logical.
+
+    Args:
+        t (Table): table
+        file_name (string): FITS file
+    """
+    t = Table(t, copy=False)
+    for name in t.colnames:
+        if t[name].dtype == np.int8:
+            t[name] = t[name].astype(np.int16)
+    t.write(file_name, overwrite=True)
+
+
+# FITS has no signed byte, int8 is saved as int16
+fits_formats = {
+    "f8": ("D", ">f8"),
+    "f4": ("E", ">f4"),
+    "i8": ("K", ">i8"),
+    "i4": ("J", ">i4"),
+    "i2": ("I", ">i2"),
+    "i1": ("I", ">i2"),
+    "u1": ("B", "u1"),
+    "b1": ("L", "S1"),
+}
+
+
+class FitsTableWriter:
+    """Write a FITS binary table chunk by chunk
+
+    The header is written first with no rows. The rows are then appended
+    as they come and NAXIS2 is fixed when the file is closed, so only one
+    chunk is held in memory at a time.
+
+    Args:
+        file_name (string): FITS file
+        dtype (list): (column name, dtype) of each column
+    """
+
+    def __init__(self, file_name, dtype):
+        self.names = [name for name, dt in dtype]
+        cols = list()
+        record = list()
+        for name, dt in dtype:
+            form, storage = fits_formats[np.dtype(dt).str[1:]]
+            cols.append(fits.Column(name=name, format=form))
+            record.append((name, storage))
+        self.header = fits.BinTableHDU.from_columns(cols, nrows=0).header
+        self.record = np.dtype(record)
+        self.rows = 0
+        self.f = open(file_name, "wb")
+        self.f.write(fits.PrimaryHDU().header.tostring().encode())
+        self.offset = self.f.tell()
+        self.f.write(self.header.tostring().encode())
+
+    def write(self, data):
+        """Append rows
+
+        Args:
+            data (dictionary): column name -> array
+        """
+        rows = len(data[self.names[0]])
+        rec = np.empty(rows, self.record)
+        for name in self.names:
+            if self.record[name].char == "S":
+                rec[name] = np.where(data[name], b"T", b"F")
+            else:
+                rec[name] = data[name]
+        self.f.write(rec.tobytes())
+        self.rows += rows
+
+    def close(self):
+        """Pad the data, fix the number of rows and close the file"""
+        size = self.rows * self.record.itemsize
+        self.f.write(b"\0" * (-size % 2880))
+        self.header["NAXIS2"] = self.rows
+        self.f.seek(self.offset)
+        self.f.write(self.header.tostring().encode())
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,4 +1,8 @@
+import os
+import sys
+import json
 import argparse
+import subprocess
 
 from random import shuffle
 from collections import Counter
@@ -6,8 +10,13 @@ from collections import Counter
 import numpy as np
 import pandas as pd
 
+import astropy.table
+
 from astropy.table import Table
 
+import catalog
+import placement
+
 
 def histogram_equal(x, nbin):
     """Histogram objects into equal number
@@ -39,38 +48,220 @@ def get_data(file_name):
     return df
 
 
-def generate_complete(df, filter_list, total_num):
+def generate_complete(df, filter_list, total_num, weights=None):
+    """Generate fake magnitudes from the observed stars
+
+    Each fake star copies the magnitudes of an observed star with a
+    uniform +-0.25 mag jitter in every filter.
+
+    Args:
+        df (DataFrame): data
+        filter_list (list): filter list
+        total_num (float): number of fake stars
+        weights (array): probability to copy each observed star, every star
+                         the same number of times if None
+                         (None)
+
+    Returns:
+        df_fake (DataFrame): fake magnitudes
+    """
     fake_dict = dict()
-    multiple = int(np.ceil(total_num / len(df)))
+    if weights is None:
+        multiple = int(np.ceil(total_num / len(df)))
+        index = np.tile(np.arange(len(df)), multiple)
+    else:
+        index = np.random.choice(
+            len(df), int(np.ceil(total_num)), p=weights / np.sum(weights)
+        )
     for filter_name in filter_list:
         fake_dict["{0}_VEGA".format(filter_name)] = (
-            np.array(multiple * list(df["{0}_VEGA".format(filter_name)]))
-            + np.random.random(len(df) * multiple) * 0.5
+            df["{0}_VEGA".format(filter_name)].to_numpy()[index]
+            + np.random.random(len(index)) * 0.5
             - 0.25
         )
     df_fake = pd.DataFrame(fake_dict)
     return df_fake
 
 
-def add_xy(df_fake, df):
+def generate_fake(df, filter_list, total_num, weights=None, stratified=False):
+    """Generate a fake star list, split evenly between the chips
+
+    Args:
+        df (DataFrame): data
+        filter_list (list): filter list
+        total_num (int): number of fake stars
+        weights (array): probability to copy each observed star
+                         (None)
+        stratified (boolean): spread the positions evenly over each chip
+                              (False)
+
+    Returns:
+        df_fake (DataFrame): fake star list
+    """
+    chip_num = len(Counter(df["chip"]))
+    fake_list = list()
+    for chip in range(1, chip_num + 1):
+        sel = (df.chip == chip).to_numpy()
+        df_chip = df[sel]
+        df_fake = generate_complete(
+            df_chip,
+            filter_list,
+            total_num / chip_num,
+            None if weights is None else weights[sel],
+        )
+        df_fake = add_xy(df_fake, df_chip, stratified)
+        df_fake = df_fake.assign(chip=np.ones(len(df_fake)) * chip)
+        fake_list.append(df_fake)
+
+    df_fake = pd.concat(fake_list)
+    df_fake.reset_index(inplace=True, drop=True)
+    return df_fake
+
+
+def add_xy(df_fake, df, stratified=False):
     """Add fake XY to data
 
+    With stratified, the positions are spread evenly over the range of the
+    data, one in each cell of a grid, so that fake.py --separation packs
+    them in full runs.
+
     Args:
         df_fake (DataFrame): fake data
         df (DataFrame): data
+        stratified (boolean): one position per cell instead of uniform ones
+                              (False)
     """
     num = len(df_fake)
     X_min = min(df["X"])
     Y_min = min(df["Y"])
     X_max = max(df["X"])
     Y_max = max(df["Y"])
-    X_fake = np.random.uniform(X_min, X_max, num)
-    Y_fake = np.random.uniform(Y_min, Y_max, num)
+    if stratified:
+        X_fake, Y_fake = placement.stratified_xy(num, (X_min, X_max), (Y_min, Y_max))
+    else:
+        X_fake = np.random.uniform(X_min, X_max, num)
+        Y_fake = np.random.uniform(Y_min, Y_max, num)
     df_fake = df_fake.assign(X=X_fake)
     df_fake = df_fake.assign(Y=Y_fake)
     return df_fake
 
 
+def completeness_limits(mag, flag, edges, levels, min_count=10, nboot=200):
+    """Completeness limits and their bootstrap errors
+
+    The limit of a level is where the binned completeness, going fainter,
+    first drops below it, interpolated between the bin centres. The error
+    is the scatter of the limits of binomial resamplings of the bins. A
+    limit is NaN, and left out of the scatter, unless the drop is between
+    two bins with at least min_count stars.
+
+    Args:
+        mag (array): input magnitudes
+        flag (array): whether each fake star is recovered
+        edges (array): magnitude bin edges
+        levels (list): completeness levels, e.g. 0.9 and 0.5
+        min_count (int): fewest stars of a bin used
+                         (10)
+        nboot (int): number of resamplings
+                     (200)
+
+    Returns:
+        limits (array): limit of each level, NaN if unresolved
+        errors (array): error of each limit, NaN if unresolved
+        completeness (array): completeness of each bin, NaN if too few stars
+    """
+    nbins = len(edges) - 1
+    index = np.clip(np.searchsorted(edges, mag, side="right") - 1, 0, nbins - 1)
+    total = np.bincount(index, minlength=nbins)
+    found = np.bincount(index[flag], minlength=nbins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        completeness = np.where(total >= min_count, found / total, np.nan)
+    samples = np.random.binomial(
+        total, np.nan_to_num(completeness), size=(nboot, nbins)
+    ) / np.maximum(total, 1)
+    samples[:, np.isnan(completeness)] = np.nan
+    curves = np.vstack([completeness, samples])
+    centres = (edges[1:] + edges[:-1]) / 2
+    limits = np.zeros((len(levels), len(curves)))
+    rows = np.arange(len(curves))
+    for n, level in enumerate(levels):
+        below = curves < level
+        k = np.argmax(below, axis=1)
+        previous = np.maximum(k - 1, 0)
+        c0 = curves[rows, previous]
+        c1 = curves[rows, k]
+        # a curve which never drops below the level, starts below it, or
+        # drops next to a bin with too few stars does not locate the limit
+        resolved = below.any(axis=1) & (k > 0) & ~np.isnan(c0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.clip((c0 - level) / (c0 - c1), 0, 1)
+        limit = centres[previous] + t * (centres[k] - centres[previous])
+        limits[n] = np.where(resolved, limit, np.nan)
+    errors = np.full(len(levels), np.nan)
+    for n in range(len(levels)):
+        sample = limits[n, 1:][~np.isnan(limits[n, 1:])]
+        if not np.isnan(limits[n, 0]) and len(sample) > 1:
+            errors[n] = np.std(sample)
+    return limits[:, 0], errors, completeness
+
+
+def transition_weights(df, filter_list, curves, edges, floor=0.05):
+    """Weight of each observed star for the next fake star batch
+
+    The weight of a bin is the binomial scatter sqrt(c (1 - c)) of its
+    completeness c, largest at the transition and small where every star
+    or none is recovered, and 0.5 in the bins without enough stars. A star
+    takes the largest weight of its magnitudes.
+
+    Args:
+        df (DataFrame): data
+        filter_list (list): filter list
+        curves (dictionary): filter name -> completeness of each bin
+        edges (dictionary): filter name -> magnitude bin edges
+        floor (float): smallest weight
+                       (0.05)
+
+    Returns:
+        weights (array): weight of each star
+    """
+    weights = np.zeros(len(df))
+    for filter_name in filter_list:
+        c = curves[filter_name]
+        bin_weights = np.where(np.isnan(c), 0.5, np.sqrt(c * (1 - c))) + floor
+        mag = df["{0}_VEGA".format(filter_name)].to_numpy()
+        index = np.clip(
+            np.searchsorted(edges[filter_name], mag, side="right") - 1,
+            0,
+            len(c) - 1,
+        )
+        weights = np.maximum(weights, bin_weights[index])
+    return weights
+
+
+def run_batch(name, run, core):
+    """Run fake.py and photfake.py on the fake star file name.fits
+
+    Args:
+        name (string): fake star file name without .fits
+        run (int): number of fake stars per run
+        core (int): number of cores
+
+    Returns:
+        code (int): exit status of the first step which fails, 0 if none
+    """
+    path = os.path.dirname(os.path.abspath(__file__))
+    for script, flags in [("fake.py", " --force"), ("photfake.py", "")]:
+        code = subprocess.call(
+            "{0} {1}/{2} -f {3} -r {4:d} -c {5:d}{6}".format(
+                sys.executable, path, script, name, run, core, flags
+            ),
+            shell=True,
+        )
+        if code != 0:
+            return code
+    return 0
+
+
 def get_filters(df):
     filter_list = []
     for key in df.keys():
@@ -85,21 +276,119 @@ if __name__ == "__main__":
     parser.add_argument(
         "-n", "--num", type=int, default=50000, help="Num of fake stars (50000)"
     )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Run batches of fake stars until the limits are precise (False)",
+    )
+    parser.add_argument(
+        "--batch", type=int, default=10000, help="Num of fake stars per batch (10000)"
+    )
+    parser.add_argument(
+        "--max-batch", type=int, default=10, help="Max number of batches (10)"
+    )
+    parser.add_argument(
+        "--precision",
+        type=float,
+        default=0.02,
+        help="Target error of the 50%% and 90%% limits in mag (0.02)",
+    )
+    parser.add_argument(
+        "--mag-bin", type=float, default=0.1, help="Magnitude bin size (0.1)"
+    )
+    parser.add_argument(
+        "-r", "--run", type=int, default=100, help="Number of fake stars per run (100)"
+    )
+    parser.add_argument(
+        "-c", type=int, default=os.cpu_count(), help="Number of cores (all)"
+    )
+    parser.add_argument(
+        "--stratified",
+        action="store_true",
+        help="Spread the fake stars evenly for fake.py --separation (False)",
+    )
     args = parser.parse_args()
     total_num = args.num
     df = get_data("final/o.gst.fits")
     filter_list = get_filters(df)
-    chip_num = len(Counter(df["chip"]))
 
-    fake_list = list()
-    for chip in range(1, chip_num + 1):
-        df_chip = df[df.chip == chip]
-        df_fake = generate_complete(df_chip, filter_list, total_num / chip_num)
-        df_fake = add_xy(df_fake, df_chip)
-        df_fake = df_fake.assign(chip=np.ones(len(df_fake)) * chip)
-        fake_list.append(df_fake)
+    if not args.adaptive:
+        df_fake = generate_fake(df, filter_list, total_num, stratified=args.stratified)
+        t = Table.from_pandas(df_fake)
+        t.write("complete.fits", overwrite=True)
 
-    df_fake = pd.concat(fake_list)
-    df_fake.reset_index(inplace=True, drop=True)
-    t = Table.from_pandas(df_fake)
-    t.write("complete.fits", overwrite=True)
+    else:
+        levels = [0.9, 0.5]
+        edges = dict()
+        for filter_name in filter_list:
+            mag = df["{0}_VEGA".format(filter_name)]
+            low = np.floor((mag.min() - 0.25) / args.mag_bin) * args.mag_bin
+            high = np.ceil((mag.max() + 0.25) / args.mag_bin) * args.mag_bin
+            edges[filter_name] = np.linspace(
+                low, high, int(round((high - low) / args.mag_bin)) + 1
+            )
+        weights = np.ones(len(df))
+        history = list()
+        results = list()
+        offset = 0
+        for batch in range(1, args.max_batch + 1):
+            name = "complete{0:d}".format(batch)
+            print(
+                "Batch {0:d}: {1:d} fake stars in {2}.fits".format(
+                    batch, args.batch, name
+                )
+            )
+            df_fake = generate_fake(
+                df, filter_list, args.batch, weights, args.stratified
+            )
+            Table.from_pandas(df_fake).write("{0}.fits".format(name), overwrite=True)
+            code = run_batch(name, args.run, args.c)
+            if code != 0:
+                print("Batch {0:d} failed with exit status {1:d}".format(batch, code))
+                sys.exit(code)
+
+            t = Table.read("final/f.{0}.fits".format(name))
+            t["batch"] = np.full(len(t), batch, dtype=np.int16)
+            if "ID" in t.colnames:
+                # the IDs of a batch start at 0, count on from the earlier ones
+                t["ID"] += offset
+            offset += len(df_fake)
+            results.append(t)
+            t = astropy.table.vstack(results)
+            catalog.write_fits(t, "final/f.adaptive.fits")
+
+            curves = dict()
+            precise = True
+            entry = {"batch": batch, "stars": len(t)}
+            for filter_name in filter_list:
+                limits, errors, curves[filter_name] = completeness_limits(
+                    np.asarray(t["{0}_VEGA_IN".format(filter_name)]),
+                    np.asarray(t["flag"], dtype=bool),
+                    edges[filter_name],
+                    levels,
+                )
+                for level, limit, error in zip(levels, limits, errors):
+                    key = "{0}_{1:.0f}".format(filter_name, level * 100)
+                    if np.isnan(error):
+                        print(
+                            "{0} {1:.0f}% limit is not resolved by the bins".format(
+                                filter_name, level * 100
+                            )
+                        )
+                        entry[key] = None
+                        precise = False
+                        continue
+                    print(
+                        "{0} {1:.0f}% limit {2:.3f} +- {3:.3f}".format(
+                            filter_name, level * 100, limit, error
+                        )
+                    )
+                    entry[key] = [float(limit), float(error)]
+                    precise &= bool(error <= args.precision)
+            history.append(entry)
+            with open("final/comp.limits.json", "w") as f:
+                json.dump(history, f, indent=1)
+            if precise:
+                print("Limits reached the precision of {0} mag".format(args.precision))
+                break
+            weights = transition_weights(df, filter_list, curves, edges)
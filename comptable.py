@@ -0,0 +1,472 @@
+import os
+import json
+import argparse
+import itertools
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from astropy.table import Table
+
+
+def bin_index(values, edges):
+    """Bin of each value
+
+    Args:
+        values (array): values
+        edges (array): bin edges
+
+    Returns:
+        index (array): bin of each value, -1 if outside the edges
+    """
+    index = np.searchsorted(edges, values, side="right") - 1
+    index[np.asarray(values) == edges[-1]] = len(edges) - 2
+    index[(index < 0) | (index > len(edges) - 2)] = -1
+    return index
+
+
+def binned_quantiles(index, values, nbins, quantiles):
+    """Quantiles of the values in each bin
+
+    The values are sorted once by bin and value, and the quantiles of all
+    the bins are interpolated together.
+
+    Args:
+        index (array): bin of each value, -1 to skip it
+        values (array): values
+        nbins (int): number of bins
+        quantiles (list): quantiles within [0, 1]
+
+    Returns:
+        result (array): quantiles x bins, NaN in the empty bins
+    """
+    good = (index >= 0) & np.isfinite(values)
+    index = index[good]
+    values = values[good]
+    order = np.lexsort((values, index))
+    values = values[order]
+    counts = np.bincount(index, minlength=nbins)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    result = np.full((len(quantiles), nbins), np.nan)
+    filled = counts > 0
+    for n, q in enumerate(quantiles):
+        position = starts[filled] + q * (counts[filled] - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, starts[filled] + counts[filled] - 1)
+        frac = position - low
+        result[n, filled] = values[low] * (1 - frac) + values[high] * frac
+    return result
+
+
+class DensityMap:
+    """Local stellar density, in stars per cell, on a grid of each chip
+
+    Args:
+        cell (float): cell size in pixels
+    """
+
+    def __init__(self, cell):
+        self.cell = float(cell)
+        self.maps = dict()
+
+    def fit(self, chip, x, y):
+        """Count the stars in each cell
+
+        Args:
+            chip, x, y (array): positions of the stars
+        """
+        cell = self.cell
+        for c in np.unique(chip):
+            sel = chip == c
+            nx = int(np.max(x[sel]) // cell) + 1
+            ny = int(np.max(y[sel]) // cell) + 1
+            counts = np.zeros((ny, nx), dtype=np.float32)
+            np.add.at(
+                counts,
+                ((y[sel] // cell).astype(np.int64), (x[sel] // cell).astype(np.int64)),
+                1,
+            )
+            self.maps[int(c)] = counts
+
+    def __call__(self, chip, x, y):
+        """Density at positions
+
+        Args:
+            chip, x, y (array): positions
+
+        Returns:
+            density (array): stars per cell, 0 outside the map
+        """
+        density = np.zeros(len(x), dtype=np.float32)
+        for c, counts in self.maps.items():
+            sel = chip == c
+            i = (np.asarray(x)[sel] // self.cell).astype(np.int64)
+            j = (np.asarray(y)[sel] // self.cell).astype(np.int64)
+            inside = (i >= 0) & (j >= 0) & (i < counts.shape[1]) & (j < counts.shape[0])
+            values = np.zeros(len(i), dtype=np.float32)
+            values[inside] = counts[j[inside], i[inside]]
+            density[sel] = values
+        return density
+
+
+def build_table(data, filters, axes, min_count=5):
+    """Completeness, magnitude bias and spread on a grid
+
+    The completeness is the fraction of fake stars with flag in each bin.
+    The bias is the median of output - input magnitude of the stars with
+    flag, and the spread is its sigma from the interquartile range.
+
+    Args:
+        data (dictionary): column name -> array, with the input magnitudes
+                           {filter}_VEGA_IN, the output {filter}_VEGA,
+                           flag and the other axes
+        filters (list): filter names
+        axes (list): (column name, bin edges) of each axis
+        min_count (int): fewest stars of a bin with a value
+                         (5)
+
+    Returns:
+        table (dictionary): name -> array of the grid
+    """
+    shape = tuple(len(edges) - 1 for name, edges in axes)
+    index = np.zeros(len(data["flag"]), dtype=np.int64)
+    for name, edges in axes:
+        axis_index = bin_index(np.asarray(data[name]), edges)
+        index = np.where(
+            (index < 0) | (axis_index < 0), -1, index * (len(edges) - 1) + axis_index
+        )
+    nbins = int(np.prod(shape))
+    flag = np.asarray(data["flag"], dtype=bool)
+    total = np.bincount(index[index >= 0], minlength=nbins)
+    found = np.bincount(index[(index >= 0) & flag], minlength=nbins)
+    table = {"total": total.reshape(shape).astype(np.int32)}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        completeness = found / total
+    completeness[total < min_count] = np.nan
+    table["completeness"] = completeness.reshape(shape).astype(np.float32)
+    for filter_name in filters:
+        delta = np.asarray(data[filter_name + "_VEGA"], dtype=np.float64) - np.asarray(
+            data[filter_name + "_VEGA_IN"], dtype=np.float64
+        )
+        q25, q50, q75 = binned_quantiles(
+            np.where(flag, index, -1), delta, nbins, [0.25, 0.5, 0.75]
+        )
+        q50[found < min_count] = np.nan
+        spread = (q75 - q25) / 1.349
+        spread[found < min_count] = np.nan
+        table["bias_" + filter_name] = q50.reshape(shape).astype(np.float32)
+        table["spread_" + filter_name] = spread.reshape(shape).astype(np.float32)
+    return table
+
+
+def save_table(file_name, table, axes, filters, density=None):
+    """Save a lookup table
+
+    Args:
+        file_name (string): .npz file
+        table (dictionary): name -> array of the grid
+        axes (list): (column name, bin edges) of each axis
+        filters (list): filter names
+        density (DensityMap): density map of the density axis
+                              (None)
+    """
+    meta = {"axes": [name for name, edges in axes], "filters": filters}
+    arrays = {"edges_{0:d}".format(n): edges for n, (name, edges) in enumerate(axes)}
+    if density is not None:
+        meta["density_cell"] = density.cell
+        for c, counts in density.maps.items():
+            arrays["density_{0:d}".format(c)] = counts
+    np.savez_compressed(file_name, meta=json.dumps(meta), **arrays, **table)
+
+
+def fill_empty(grid):
+    """Fill the bins without a value from their neighbours
+
+    Each empty bin next to bins with a value takes their mean, until the
+    grid is full.
+
+    Args:
+        grid (array): values, NaN in the empty bins
+
+    Returns:
+        grid (array): filled float32 copy
+    """
+    grid = grid.astype(np.float32)
+    while True:
+        empty = np.isnan(grid)
+        if not empty.any() or empty.all():
+            return grid
+        padded = np.pad(grid, 1, constant_values=np.nan)
+        total = np.zeros_like(grid)
+        count = np.zeros_like(grid)
+        for axis in range(grid.ndim):
+            for start in (0, 2):
+                window = [slice(1, -1)] * grid.ndim
+                window[axis] = slice(start, start + grid.shape[axis])
+                neighbour = padded[tuple(window)]
+                finite = np.isfinite(neighbour)
+                total += np.where(finite, neighbour, 0)
+                count += finite
+        fill = empty & (count > 0)
+        grid[fill] = total[fill] / count[fill]
+
+
+class CompletenessTable:
+    """Evaluate a lookup table saved by save_table
+
+    The values are interpolated linearly between the bin centres of the
+    continuous axes, and taken from the nearest bin of the chip axis and
+    outside the grid. The bins without a value are filled from their
+    neighbours when the table is read.
+
+    Args:
+        file_name (string): .npz file
+        core (int): number of threads
+                    (all)
+    """
+
+    def __init__(self, file_name, core=None):
+        self.core = core or os.cpu_count() or 1
+        with np.load(file_name) as f:
+            meta = json.loads(str(f["meta"]))
+            self.axes = meta["axes"]
+            self.filters = meta["filters"]
+            self.edges = [f["edges_{0:d}".format(n)] for n in range(len(self.axes))]
+            self.table = {
+                k: f[k]
+                for k in f.files
+                if not k.startswith(("edges_", "density_")) and k != "meta"
+            }
+            self.density = None
+            if "density_cell" in meta:
+                self.density = DensityMap(meta["density_cell"])
+                self.density.maps = {
+                    int(k.split("_")[1]): f[k]
+                    for k in f.files
+                    if k.startswith("density_")
+                }
+        self.shape = self.table["total"].shape
+        self.strides = np.cumprod((self.shape[1:] + (1,))[::-1])[::-1]
+        self.grids = {
+            k: fill_empty(v).ravel() for k, v in self.table.items() if k != "total"
+        }
+
+    def locate(self, values):
+        """Bins and weights of positions along each axis
+
+        Args:
+            values (dictionary): axis name -> array
+
+        Returns:
+            base (array): flat bin of the lower corner
+            linear (list): (stride, fraction) of each interpolated axis
+        """
+        base = 0
+        linear = list()
+        for name, edges, stride in zip(self.axes, self.edges, self.strides):
+            v = np.asarray(values[name], dtype=np.float32)
+            n = len(edges) - 1
+            width = np.diff(edges)
+            uniform = np.allclose(width, width[0], rtol=1e-4)
+            if name == "chip" or n == 1:
+                if uniform:
+                    u = (v - np.float32(edges[0])) * np.float32(1 / width[0])
+                    i = np.floor(u, out=u).astype(np.int32)
+                else:
+                    i = (np.searchsorted(edges, v, "right") - 1).astype(np.int32)
+                np.clip(i, 0, n - 1, out=i)
+                i *= np.int32(stride)
+                base = base + i
+                continue
+            centres = ((edges[1:] + edges[:-1]) / 2).astype(np.float32)
+            if uniform:
+                u = v * np.float32(1 / width[0])
+                u -= np.float32(centres[0] / width[0])
+                lower = np.floor(u)
+                np.clip(lower, 0, n - 2, out=lower)
+                t = np.subtract(u, lower, out=u)
+                i = lower.astype(np.int32)
+            else:
+                i = np.clip(np.searchsorted(centres, v) - 1, 0, n - 2).astype(np.int32)
+                t = (v - centres[i]) / (centres[i + 1] - centres[i])
+            np.clip(t, 0, 1, out=t)
+            i *= np.int32(stride)
+            base = base + i
+            linear.append((stride, t))
+        return base, linear
+
+    def interpolate(self, names, values, chunk=1 << 18):
+        """Interpolate several tables together
+
+        The positions are split into chunks evaluated by a pool of threads.
+
+        Args:
+            names (list): table names
+            values (dictionary): axis name -> array
+            chunk (int): number of positions per thread task
+                         (262144)
+
+        Returns:
+            result (dictionary): table name -> interpolated values
+        """
+        rows = len(np.asarray(values[self.axes[0]]))
+        result = {name: np.empty(rows, dtype=np.float32) for name in names}
+
+        def inner_interpolate(start):
+            base, linear = self.locate(
+                {k: np.asarray(values[k])[start : start + chunk] for k in self.axes}
+            )
+            complement = [1 - t for stride, t in linear]
+            out = {name: result[name][start : start + chunk] for name in names}
+            for name in names:
+                out[name][:] = 0
+            for bits in itertools.product((0, 1), repeat=len(linear)):
+                offset = 0
+                weight = None
+                for bit, (stride, t), s in zip(bits, linear, complement):
+                    offset += bit * stride
+                    factor = t if bit else s
+                    weight = factor if weight is None else weight * factor
+                for name in names:
+                    value = self.grids[name][offset:][base]
+                    if weight is not None:
+                        value *= weight
+                    out[name] += value
+
+        with ThreadPoolExecutor(self.core) as executor:
+            list(executor.map(inner_interpolate, range(0, rows, chunk)))
+        return result
+
+    def evaluate(self, name, values):
+        """Interpolate one table
+
+        Args:
+            name (string): completeness, bias_{filter} or spread_{filter}
+            values (dictionary): axis name -> array
+
+        Returns:
+            result (array): interpolated values
+        """
+        return self.interpolate([name], values)[name]
+
+    def completeness(self, values):
+        """Completeness
+
+        Args:
+            values (dictionary): axis name -> array
+
+        Returns:
+            completeness (array): completeness
+        """
+        return self.evaluate("completeness", values)
+
+    def draw(self, values, rng=None):
+        """Draw the detection and the output magnitudes of synthetic stars
+
+        Args:
+            values (dictionary): axis name -> array, with {filter}_VEGA_IN
+            rng (Generator): random generator
+                             (None)
+
+        Returns:
+            detected (array): boolean mask
+            mags (dictionary): filter name -> output magnitude
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        names = ["completeness"]
+        for filter_name in self.filters:
+            names += ["bias_" + filter_name, "spread_" + filter_name]
+        result = self.interpolate(names, values)
+        completeness = result["completeness"]
+        detected = rng.random(len(completeness), dtype=np.float32) < completeness
+        mags = dict()
+        for filter_name in self.filters:
+            mags[filter_name] = (
+                np.asarray(values[filter_name + "_VEGA_IN"], dtype=np.float32)
+                + result["bias_" + filter_name]
+                + result["spread_" + filter_name]
+                * rng.standard_normal(len(completeness), dtype=np.float32)
+            )
+        return detected, mags
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-f", "--folder", default="complete", help="Fake star folder name (complete)"
+    )
+    parser.add_argument(
+        "--mag-bin", type=float, default=0.1, help="Magnitude bin size (0.1)"
+    )
+    parser.add_argument("--chip", action="store_true", help="Bin by chip (False)")
+    parser.add_argument(
+        "--xy-bins", type=int, default=0, help="Number of X and Y bins, 0 for none (0)"
+    )
+    parser.add_argument(
+        "--density",
+        type=float,
+        help="Cell size in pixels of the local density of o.gst.fits (None)",
+    )
+    parser.add_argument(
+        "--density-bins", type=int, default=4, help="Number of density bins (4)"
+    )
+    parser.add_argument(
+        "--min-count", type=int, default=5, help="Fewest stars of a bin (5)"
+    )
+    args = parser.parse_args()
+
+    t = Table.read("final/f.{0}.fits".format(args.folder))
+    data = {name: np.asarray(t[name]) for name in t.colnames}
+    filters = [j[:-8] for j in t.colnames if j.endswith("_VEGA_IN")]
+
+    axes = list()
+    for filter_name in filters:
+        m = data[filter_name + "_VEGA_IN"]
+        low = np.floor(float(np.min(m)) / args.mag_bin) * args.mag_bin
+        high = np.ceil(float(np.max(m)) / args.mag_bin) * args.mag_bin
+        axes.append(
+            (
+                filter_name + "_VEGA_IN",
+                np.linspace(low, high, int(round((high - low) / args.mag_bin)) + 1),
+            )
+        )
+    if args.chip:
+        chips = np.unique(data["chip"])
+        axes.append(("chip", np.append(chips - 0.5, chips[-1] + 0.5)))
+    if args.xy_bins:
+        for name in ["X", "Y"]:
+            axes.append(
+                (
+                    name,
+                    np.linspace(
+                        float(np.min(data[name])),
+                        float(np.max(data[name])),
+                        args.xy_bins + 1,
+                    ),
+                )
+            )
+    density = None
+    if args.density:
+        gst = Table.read("final/o.gst.fits")
+        density = DensityMap(args.density)
+        density.fit(np.asarray(gst["chip"]), np.asarray(gst["X"]), np.asarray(gst["Y"]))
+        data["density"] = density(data["chip"], data["X"], data["Y"])
+        edges = np.unique(
+            np.quantile(data["density"], np.linspace(0, 1, args.density_bins + 1))
+        )
+        if len(edges) < 2:
+            # a single density, counted in stars, gets one bin around it
+            edges = np.array([edges[0] - 0.5, edges[0] + 0.5])
+        axes.append(("density", edges))
+
+    print(
+        "Binning {0:d} fake stars on {1} bins".format(
+            len(t), " x ".join(str(len(edges) - 1) for name, edges in axes)
+        )
+    )
+    table = build_table(data, filters, axes, args.min_count)
+    file_name = "final/comp.{0}.npz".format(args.folder)
+    save_table(file_name, table, axes, filters, density)
+    print("Saved to {0}".format(file_name))
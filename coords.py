@@ -0,0 +1,230 @@
+import os
+
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class GridWCS:
+    """Fast approximate pixel to sky transform of a WCS
+
+    The exact transform is evaluated on a regular grid of nodes covering
+    the footprint and bilinearly interpolated in between. The grid is
+    refined until the largest residual against the exact transform, checked
+    at the cell centres and at random points, is under the tolerance. If
+    even the finest grid misses it, the exact transform is used instead.
+    Positions outside the footprint always use the exact transform.
+
+    Args:
+        w (WCS): wcs
+        xlim (tuple): (xmin, xmax) of the footprint in pixels
+        ylim (tuple): (ymin, ymax) of the footprint in pixels
+        tolerance (float): largest residual allowed in mas
+                           (1)
+        step (int): initial grid spacing in pixels
+                    (64)
+        min_step (int): finest grid spacing in pixels
+                        (4)
+        core (int): number of threads
+                    (all)
+    """
+
+    def __init__(self, w, xlim, ylim, tolerance=1.0, step=64, min_step=4, core=None):
+        self.w = w
+        self.xlim = xlim
+        self.ylim = ylim
+        self.core = core or os.cpu_count() or 1
+        self.exact = False
+        rng = np.random.default_rng(1442291549)
+        x_test = rng.uniform(xlim[0], xlim[1], 10000)
+        y_test = rng.uniform(ylim[0], ylim[1], 10000)
+        while True:
+            self.fit(xlim, ylim, step)
+            x_center = self.x0 + (np.arange(self.nx - 1) + 0.5) * step
+            y_center = self.y0 + (np.arange(self.ny - 1) + 0.5) * step
+            x_center, y_center = np.meshgrid(x_center, y_center)
+            x = np.concatenate([x_center.ravel(), x_test])
+            y = np.concatenate([y_center.ravel(), y_test])
+            self.residual = self.max_residual(x, y)
+            if self.residual <= tolerance:
+                self.step = step
+                break
+            if step // 2 < min_step:
+                self.exact = True
+                break
+            step //= 2
+        if self.exact:
+            print(
+                "Grid WCS residual {0:.3f} mas above {1} mas, use exact WCS".format(
+                    self.residual, tolerance
+                )
+            )
+        else:
+            print(
+                "Grid WCS with {0:d} px step, max residual {1:.3f} mas".format(
+                    self.step, self.residual
+                )
+            )
+
+    def fit(self, xlim, ylim, step):
+        """Evaluate the exact transform on the grid nodes
+
+        Args:
+            xlim (tuple): (xmin, xmax) of the footprint in pixels
+            ylim (tuple): (ymin, ymax) of the footprint in pixels
+            step (int): grid spacing in pixels
+        """
+        self.x0 = np.floor(xlim[0]) - step
+        self.y0 = np.floor(ylim[0]) - step
+        self.nx = int(np.ceil((xlim[1] - self.x0) / step)) + 2
+        self.ny = int(np.ceil((ylim[1] - self.y0) / step)) + 2
+        self.dstep = float(step)
+        x, y = np.meshgrid(
+            self.x0 + np.arange(self.nx) * step, self.y0 + np.arange(self.ny) * step
+        )
+        ra, dec = self.w.wcs_pix2world(x, y, 1)
+        self.ra0 = ra[self.ny // 2, self.nx // 2]
+        ra = (ra - self.ra0 + 180) % 360 - 180
+        # bilinear coefficients of each cell: c0 + c1 u + c2 v + c3 u v
+        self.coeffs = list()
+        for grid in (ra, dec):
+            f00 = grid[:-1, :-1]
+            f10 = grid[:-1, 1:]
+            f01 = grid[1:, :-1]
+            f11 = grid[1:, 1:]
+            self.coeffs.append(
+                [
+                    f00.ravel(),
+                    (f10 - f00).ravel(),
+                    (f01 - f00).ravel(),
+                    (f11 - f10 - f01 + f00).ravel(),
+                ]
+            )
+
+    def max_residual(self, x, y):
+        """Largest residual of the grid against the exact transform
+
+        Args:
+            x, y (array): pixel positions
+
+        Returns:
+            residual (float): largest separation in mas
+        """
+        ra, dec = self.interpolate(x, y)
+        ra_exact, dec_exact = self.w.wcs_pix2world(x, y, 1)
+        dra = ((ra - ra_exact + 180) % 360 - 180) * np.cos(np.deg2rad(dec_exact))
+        return np.max(np.hypot(dra, dec - dec_exact)) * 3.6e6
+
+    def interpolate(self, x, y):
+        """Bilinear interpolation of the grid
+
+        Args:
+            x, y (array): pixel positions
+
+        Returns:
+            ra, dec (array): sky positions in degrees
+        """
+        u = (np.asarray(x, dtype=np.float64) - self.x0) / self.dstep
+        v = (np.asarray(y, dtype=np.float64) - self.y0) / self.dstep
+        i = np.clip(u.astype(np.int64), 0, self.nx - 2)
+        j = np.clip(v.astype(np.int64), 0, self.ny - 2)
+        u -= i
+        v -= j
+        cell = j * (self.nx - 1) + i
+        result = list()
+        for c0, c1, c2, c3 in self.coeffs:
+            value = c3[cell]
+            value *= v
+            value += c1[cell]
+            value *= u
+            value += c0[cell]
+            value += c2[cell] * v
+            result.append(value)
+        result[0] += self.ra0
+        return result[0] % 360, result[1]
+
+    def transform(self, x, y):
+        """Interpolate inside the footprint, exact transform outside
+
+        Args:
+            x, y (array): pixel positions
+
+        Returns:
+            ra, dec (array): sky positions in degrees
+        """
+        ra, dec = self.interpolate(x, y)
+        outside = (
+            (x < self.xlim[0])
+            | (x > self.xlim[1])
+            | (y < self.ylim[0])
+            | (y > self.ylim[1])
+        )
+        if outside.any():
+            ra[outside], dec[outside] = self.w.wcs_pix2world(x[outside], y[outside], 1)
+        return ra, dec
+
+    def __call__(self, x, y, chunk=1000000):
+        """Transform pixel positions into sky positions
+
+        Args:
+            x, y (array): pixel positions, with origin 1
+            chunk (int): number of positions per thread task
+                         (1000000)
+
+        Returns:
+            ra, dec (array): sky positions in degrees
+        """
+        if self.exact:
+            return self.w.wcs_pix2world(x, y, 1)
+        x = np.asarray(x)
+        y = np.asarray(y)
+        starts = range(0, len(x), chunk)
+        with ThreadPoolExecutor(self.core) as executor:
+            parts = list(
+                executor.map(
+                    lambda start: self.transform(
+                        x[start : start + chunk], y[start : start + chunk]
+                    ),
+                    starts,
+                )
+            )
+        if not parts:
+            return np.zeros(0), np.zeros(0)
+        return (
+            np.concatenate([j[0] for j in parts]),
+            np.concatenate([j[1] for j in parts]),
+        )
+
+
+def exact_pix2world(w, x, y):
+    """Exact pixel to sky transform, origin 1, which can be pickled
+
+    Args:
+        w (WCS): wcs
+        x, y (array): pixel positions
+
+    Returns:
+        ra, dec (array): sky positions in degrees
+    """
+    return w.wcs_pix2world(x, y, 1)
+
+
+def pix2world(w, shape, tolerance=0, core=None):
+    """Pixel to sky transform of an image
+
+    Args:
+        w (WCS): wcs
+        shape (tuple): (ny, nx) of the image
+        tolerance (float): largest residual allowed in mas, 0 for the exact
+                           transform
+                           (0)
+        core (int): number of threads of the grid transform
+                    (all)
+
+    Returns:
+        transform (function): (x, y) -> (ra, dec), origin 1
+    """
+    if tolerance <= 0:
+        return partial(exact_pix2world, w)
+    return GridWCS(w, (0, shape[1] + 1), (0, shape[0] + 1), tolerance, core=core)
@@ -0,0 +1,93 @@
+import json
+import argparse
+
+from collections import OrderedDict
+
+import numpy as np
+
+from astropy.table import Table
+
+default_cuts = OrderedDict(
+    [("snr", 5.0), ("sharp", 0.04), ("crowd", 0.5), ("objtype", 1), ("flag", 99)]
+)
+
+
+def read_cuts(file_name=None):
+    """Read the quality cuts
+
+    The file is a JSON object overriding some of default_cuts. A cut set
+    to null is not applied.
+
+    Args:
+        file_name (string): JSON file, None for the default cuts
+                            (None)
+
+    Returns:
+        cuts (OrderedDict): cut name -> threshold
+    """
+    cuts = OrderedDict(default_cuts)
+    if file_name is not None:
+        with open(file_name) as f:
+            user_cuts = json.load(f)
+        unknown = set(user_cuts) - set(cuts)
+        if unknown:
+            raise ValueError("Unknown cuts: {0}".format(", ".join(sorted(unknown))))
+        cuts.update(user_cuts)
+    return cuts
+
+
+def get_filters(columns):
+    """Get the filters of a catalog from its _SNR columns
+
+    Args:
+        columns (list): column names
+
+    Returns:
+        filters (list): filter names
+    """
+    return [j[:-4] for j in columns if j.endswith("_SNR")]
+
+
+def good_stars(data, filters, cuts=default_cuts):
+    """Select the stars passing the cuts in every filter
+
+    All the conditions are and-ed in place into one boolean mask.
+
+    Args:
+        data (Table, DataFrame or dictionary): catalog
+        filters (list): filter names
+        cuts (dictionary): cut name -> threshold
+                           (default_cuts)
+
+    Returns:
+        good (array): boolean mask
+    """
+    good = np.ones(len(np.asarray(data["X"])), dtype=bool)
+    if cuts["objtype"] is not None:
+        good &= np.asarray(data["OBJECT_TYPE"]) == cuts["objtype"]
+    for filter_name in filters:
+        if cuts["snr"] is not None:
+            good &= np.asarray(data[filter_name + "_SNR"]) >= cuts["snr"]
+        if cuts["sharp"] is not None:
+            good &= np.asarray(data[filter_name + "_SHARP"]) ** 2 < cuts["sharp"]
+        if cuts["crowd"] is not None:
+            good &= np.asarray(data[filter_name + "_CROWD"]) < cuts["crowd"]
+        if cuts["flag"] is not None:
+            good &= np.asarray(data[filter_name + "_FLAG"]) <= cuts["flag"]
+    return good
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i", "--input", default="final/o.summary.fits", help="Input catalog"
+    )
+    parser.add_argument("-o", "--output", default="final/o.gst.fits", help="Output")
+    parser.add_argument("--cuts", help="JSON file of the cuts (None)")
+    args = parser.parse_args()
+
+    cuts = read_cuts(args.cuts)
+    t = Table.read(args.input, memmap=True)
+    good = good_stars(t, get_filters(t.colnames), cuts)
+    print("{0:d} of {1:d} stars pass the cuts".format(good.sum(), len(t)))
+    t[good].write(args.output, overwrite=True)
@@ -2,7 +2,13 @@ import os
 import re
 import sys
 import glob
+import json
+import stat
+import time
+import shutil
+import hashlib
 import argparse
+import threading
 import subprocess
 
 from pathlib import Path
@@ -14,7 +20,17 @@ import pandas as pd
 
 from astropy.io import fits
 
-from multiprocessing import Pool
+import instrument
+
+from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    import fcntl
+
+    FICLONE = 0x40049409
+except ImportError:
+    pass
 
 
 def extract_ref(force, rawdir="raw/"):
@@ -43,6 +59,79 @@ def extract_ref(force, rawdir="raw/"):
     return filenames[index]
 
 
+def read_header(filename):
+    """Read the metadata of one exposure from its primary header
+
+    Args:
+        filename (string): file name
+
+    Returns:
+        info (dictionary): instrument, filter, detector, exposure and proposal
+    """
+    header = fits.getheader(filename, 0)
+    inst = header["INSTRUME"]
+    if inst == "ACS":
+        info = acs_info(header)
+    elif inst == "WFC3":
+        info = wfc3_info(header)
+    elif inst == "WFPC2":
+        info = wfpc2_info(header)
+    else:
+        raise ValueError("Unknown instrument {0} in {1}".format(inst, filename))
+    info["inst"] = inst
+    return info
+
+
+def read_manifest(filenames, rawdir="raw/", manifest_name="manifest.json"):
+    """Read the header metadata of files through the manifest in rawdir
+
+    Only the files whose size or mtime changed since the last scan are
+    read again. Their primary headers are scanned in parallel and the
+    manifest is saved back to rawdir.
+
+    Args:
+        filenames (list): file names in rawdir
+        rawdir (string): raw folder
+                         (raw/)
+        manifest_name (string): manifest file name
+                                (manifest.json)
+
+    Returns:
+        infos (list): header metadata of each file
+    """
+    manifest_path = os.path.join(rawdir, manifest_name)
+    manifest = dict()
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except ValueError:
+            print("Broken manifest {0}, rebuilding".format(manifest_path))
+
+    stats = dict()
+    stale = list()
+    for filename in filenames:
+        file_stat = os.stat(os.path.join(rawdir, filename))
+        stats[filename] = [file_stat.st_size, file_stat.st_mtime_ns]
+        entry = manifest.get(filename)
+        if entry is None or entry["stat"] != stats[filename]:
+            stale.append(filename)
+
+    if stale:
+        print("Scanning {0:d} headers ...".format(len(stale)))
+        with ThreadPool(min(len(stale), 4 * (os.cpu_count() or 1))) as p:
+            infos = p.map(
+                read_header, [os.path.join(rawdir, j) for j in stale], chunksize=1
+            )
+        for filename, info in zip(stale, infos):
+            manifest[filename] = {"stat": stats[filename], "info": info}
+        temp_path = manifest_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temp_path, manifest_path)
+    return [manifest[filename]["info"] for filename in filenames]
+
+
 def gen_frame(ref_file, rawdir="raw/"):
     """Generating the data frame
 
@@ -66,58 +155,33 @@ def gen_frame(ref_file, rawdir="raw/"):
 
     df = pd.DataFrame({"img_name": img_names, "type": type_list})
 
-    inst_list = list()
-    for i in range(len(df)):
-        hdu_list = fits.open("{0}/{1}".format(rawdir, df.iloc[i]["img_name"]))
-        temp = hdu_list[0].header["INSTRUME"]
-        inst_list.append(temp)
-    df["inst"] = inst_list
-
-    filter_list = list()
-    detector_list = list()
-    exp_list = list()
-    prop_list = list()
-    pr_l_list = list()
-    pr_f_list = list()
-    for i in range(len(df)):
-        if df.iloc[i]["inst"] == "ACS":
-            info = acs_info("{0}/{1}".format(rawdir, df.iloc[i]["img_name"]))
-        if df.iloc[i]["inst"] == "WFC3":
-            info = wfc3_info("{0}/{1}".format(rawdir, df.iloc[i]["img_name"]))
-        if df.iloc[i]["inst"] == "WFPC2":
-            info = wfpc2_info("{0}/{1}".format(rawdir, df.iloc[i]["img_name"]))
-        filter_list.append(info["filter"])
-        detector_list.append(info["detector"])
-        exp_list.append(info["exp"])
-        prop_list.append(info["prop"])
-        pr_l_list.append(info["pr_l"])
-        pr_f_list.append(info["pr_f"])
-    df["filter"] = filter_list
-    df["detect"] = detector_list
-    df["exp"] = exp_list
-    df["prop"] = prop_list
-    df["pr_l"] = pr_l_list
-    df["pr_f"] = pr_f_list
+    infos = read_manifest(img_names, rawdir)
+    df["inst"] = [info["inst"] for info in infos]
+    df["filter"] = [info["filter"] for info in infos]
+    df["detect"] = [info["detector"] for info in infos]
+    df["exp"] = [info["exp"] for info in infos]
+    df["prop"] = [info["prop"] for info in infos]
+    df["pr_l"] = [info["pr_l"] for info in infos]
+    df["pr_f"] = [info["pr_f"] for info in infos]
     return df
 
 
-def wfc3_info(filename):
+def wfc3_info(header):
     """get info for WFC3 instrument
 
     Args:
-        filename (string): file name
+        header (Header): primary header
 
     Returns:
         dict (dictionary): filter and detector
     """
-    hdu_list = fits.open(filename)
-    filter = hdu_list[0].header["filter"]
-    detector = hdu_list[0].header["DETECTOR"]
-    exp = hdu_list[0].header["EXPTIME"]
-    prop = hdu_list[0].header["PROPOSID"]
-    if "PR_INV_L" in hdu_list[0].header:
-        pr_l = hdu_list[0].header["PR_INV_L"]
-        pr_f = hdu_list[0].header["PR_INV_F"]
+    filter = header["filter"]
+    detector = header["DETECTOR"]
+    exp = header["EXPTIME"]
+    prop = header["PROPOSID"]
+    if "PR_INV_L" in header:
+        pr_l = header["PR_INV_L"]
+        pr_f = header["PR_INV_F"]
     else:
         pr_l = ""
         pr_f = ""
@@ -131,23 +195,22 @@ def wfc3_info(filename):
     }
 
 
-def wfpc2_info(filename):
+def wfpc2_info(header):
     """get info for WFPC2 instrument
 
     Args:
-        filename (string): file name
+        header (Header): primary header
 
     Returns:
         dict (dictionary): filter and detector
     """
-    hdu_list = fits.open(filename)
-    filter = hdu_list[0].header["FILTNAM1"]
+    filter = header["FILTNAM1"]
     detector = ""
-    exp = hdu_list[0].header["EXPTIME"]
-    prop = hdu_list[0].header["PROPOSID"]
-    if "PR_INV_L" in hdu_list[0].header:
-        pr_l = hdu_list[0].header["PR_INV_L"]
-        pr_f = hdu_list[0].header["PR_INV_F"]
+    exp = header["EXPTIME"]
+    prop = header["PROPOSID"]
+    if "PR_INV_L" in header:
+        pr_l = header["PR_INV_L"]
+        pr_f = header["PR_INV_F"]
     else:
         pr_l = ""
         pr_f = ""
@@ -161,28 +224,27 @@ def wfpc2_info(filename):
     }
 
 
-def acs_info(filename):
+def acs_info(header):
     """get info for ACS instrument
 
     Args:
-        filename (string): file name
+        header (Header): primary header
 
     Returns:
         dict (dictionary): filter and detector
     """
-    hdu_list = fits.open(filename)
-    f1 = hdu_list[0].header["filter1"]
-    f2 = hdu_list[0].header["filter2"]
+    f1 = header["filter1"]
+    f2 = header["filter2"]
     if (f1 == "CLEAR1L") | (f1 == "CLEAR1S"):
         filter = f2
     elif (f2 == "CLEAR2L") | (f2 == "CLEAR2S"):
         filter = f1
-    exp = hdu_list[0].header["EXPTIME"]
-    detector = hdu_list[0].header["DETECTOR"]
-    prop = hdu_list[0].header["PROPOSID"]
-    if "PR_INV_L" in hdu_list[0].header:
-        pr_l = hdu_list[0].header["PR_INV_L"]
-        pr_f = hdu_list[0].header["PR_INV_F"]
+    exp = header["EXPTIME"]
+    detector = header["DETECTOR"]
+    prop = header["PROPOSID"]
+    if "PR_INV_L" in header:
+        pr_l = header["PR_INV_L"]
+        pr_f = header["PR_INV_F"]
     else:
         pr_l = ""
         pr_f = ""
@@ -196,214 +258,402 @@ def acs_info(filename):
     }
 
 
-def load_files(df, rawdir="raw/"):
-    """Clean and load the data
+def clean_files(checkpoint_name="dol.checkpoint.json"):
+    """Remove the files and the checkpoints of the previous run
 
     Args:
-        df (DataFrame): data frame
+        checkpoint_name (string): checkpoint journal
+                                  (dol.checkpoint.json)
+    """
+    subprocess.call(
+        "rm -rf *.fits phot[0-9].log phot[0-9].param {0}".format(checkpoint_name),
+        shell=True,
+    )
+
+
+def raw_names(item):
+    """Raw files needed by one image
+
+    Args:
+        item (Series): image
+
+    Returns:
+        names (list): file names
+    """
+    names = [item["img_name"]]
+    if item["inst"] == "WFPC2":
+        names.append(re.sub("c0m", "c1m", item["img_name"]))
+    return names
+
+
+def stage_file(src, dst, link=False):
+    """Stage one file into the working directory
+
+    Hard links are only used when link is set, i.e. for files which are
+    never modified in place, since they share the data with rawdir. Other
+    files are cloned with a reflink, then with copy_file_range, and only
+    copied as the last resort. The staged file is always writable.
+
+    Args:
+        src (string): source file
+        dst (string): destination file
+        link (boolean): allow hard link
+                        (False)
+
+    Returns:
+        method (string): hardlink, reflink, copy_file_range or copy
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    size = os.stat(src).st_size
+    method = None
+    if link:
+        try:
+            os.link(src, dst)
+            method = "hardlink"
+        except OSError:
+            pass
+    if method is None:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = "reflink"
+            except (OSError, NameError):
+                pass
+            if method is None and hasattr(os, "copy_file_range"):
+                try:
+                    offset = 0
+                    while offset < size:
+                        count = os.copy_file_range(
+                            fsrc.fileno(), fdst.fileno(), size - offset
+                        )
+                        if count == 0:
+                            break
+                        offset += count
+                    method = "copy_file_range"
+                except OSError:
+                    fdst.seek(0)
+                    fdst.truncate()
+            if method is None:
+                fsrc.seek(0)
+                shutil.copyfileobj(fsrc, fdst, 1 << 22)
+                method = "copy"
+        os.chmod(dst, os.stat(src).st_mode | stat.S_IWUSR)
+    if os.stat(dst).st_size != size:
+        raise IOError("Staging {0} with {1} failed".format(src, method))
+    return method
+
+
+def load_file(item, rawdir="raw/"):
+    """Load one image from rawdir
+
+    Args:
+        item (Series): image
         rawdir (string): raw folder
                          (raw/)
+
+    Returns:
+        methods (list): staging method of each file
     """
-    subprocess.call("rm -rf *.fits phot[0-9].log phot[0-9].param", shell=True)
-    for i in range(len(df)):
-        subprocess.call(
-            "cp {0}/{1} {2}".format(rawdir, df.iloc[i]["img_name"], os.getcwd()),
-            shell=True,
-        )
-        if df.iloc[i].inst == "WFPC2":
-            subprocess.call(
-                "cp {0}/{1} {2}".format(
-                    rawdir, re.sub("c0m", "c1m", df.iloc[i]["img_name"]), os.getcwd()
-                ),
-                shell=True,
-            )
+    return [
+        stage_file("{0}/{1}".format(rawdir, name), name, link="c1m" in name)
+        for name in raw_names(item)
+    ]
 
 
-def mask_files(df):
-    """Mask the files
+def load_mask_file(item, rawdir="raw/", staged=None):
+    """Load and mask one image
 
     Args:
-        df (DataFrame): data frame
+        item (Series): image
+        rawdir (string): raw folder
+                         (raw/)
+        staged (list): staging methods are appended to it
+                       (None)
 
+    Returns:
+        code (int): exit status of the mask
     """
-    print("Masking ...")
-    for i in range(len(df)):
-        if df.iloc[i]["inst"] == "WFC3":
-            subprocess.call(
-                "wfc3mask " + df.iloc[i]["img_name"] + " >> phot.log", shell=True
-            )
-        elif df.iloc[i]["inst"] == "ACS":
-            subprocess.call(
-                "acsmask " + df.iloc[i]["img_name"] + " >> phot.log", shell=True
-            )
-        elif df.iloc[i]["inst"] == "WFPC2":
-            subprocess.call(
-                "wfpc2mask "
-                + df.iloc[i]["img_name"]
-                + " "
-                + re.sub("c0m", "c1m", df.iloc[i]["img_name"])
-                + " >> phot.log",
-                shell=True,
-            )
+    with instrument.stage("load"):
+        methods = load_file(item, rawdir)
+    if staged is not None:
+        staged.extend(methods)
+    return mask_file(item)
 
 
-def split_files(df):
-    """split the files
+class Checkpoint:
+    """Journal of the finished tasks
 
-    Args:
-        df (DataFrame): data frame
+    For each task it records the digests of the input files, the parameter
+    values and the digests of the output files. A task is up to date when
+    all of them still match, in which case it is not run again. Digests are
+    cached by file size and mtime so unchanged files are hashed only once.
 
+    Args:
+        filename (string): journal file
+                           (dol.checkpoint.json)
     """
-    print("Splitting ...")
-    for i in range(len(df)):
-        subprocess.call(
-            "splitgroups " + df.iloc[i]["img_name"] + " >> phot.log", shell=True
-        )
 
+    def __init__(self, filename="dol.checkpoint.json"):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.journal = {"digests": dict(), "tasks": dict()}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.journal = json.load(f)
+            except ValueError:
+                print("Broken checkpoint {0}, starting over".format(filename))
+
+    def digest(self, filename):
+        """Content digest of a file
+
+        Args:
+            filename (string): file name
+
+        Returns:
+            digest (string): blake2b digest, None if the file is missing
+        """
+        try:
+            file_stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        key = [file_stat.st_size, file_stat.st_mtime_ns]
+        with self.lock:
+            cached = self.journal["digests"].get(filename)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        h = hashlib.blake2b(digest_size=20)
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 22), b""):
+                h.update(block)
+        with self.lock:
+            self.journal["digests"][filename] = [key, h.hexdigest()]
+        return h.hexdigest()
+
+    def is_fresh(self, key, inputs, params):
+        """Check whether a task is up to date
+
+        Args:
+            key (string): task name
+            inputs (list): input files
+            params (dictionary): parameter values
+
+        Returns:
+            fresh (boolean): whether the task can be skipped
+        """
+        with self.lock:
+            record = self.journal["tasks"].get(key)
+        if record is None or record["params"] != params:
+            return False
+        if record["inputs"] != {j: self.digest(j) for j in inputs}:
+            return False
+        return all(self.digest(j) == v for j, v in record["outputs"].items())
+
+    def record(self, key, inputs, params, outputs):
+        """Record a finished task and save the journal
+
+        Args:
+            key (string): task name
+            inputs (list): input files
+            params (dictionary): parameter values
+            outputs (list): output files
+        """
+        record = {
+            "inputs": {j: self.digest(j) for j in inputs},
+            "params": params,
+            "outputs": {j: self.digest(j) for j in outputs},
+        }
+        with self.lock:
+            self.journal["tasks"][key] = record
+            temp_name = self.filename + ".tmp"
+            with open(temp_name, "w") as f:
+                json.dump(self.journal, f, indent=1, sort_keys=True)
+            os.replace(temp_name, self.filename)
+
+    def run(self, key, func, args, inputs, params, outputs):
+        """Run a task unless it is up to date
+
+        A failed task, or one which misses an output, raises a RuntimeError,
+        which stops the tasks depending on it.
+
+        Args:
+            key (string): task name
+            func (function): task function, returning the exit status
+            args (tuple): arguments of func
+            inputs (list): input files
+            params (dictionary): parameter values
+            outputs (function): returns the output files once func has run
+        """
+        if self.is_fresh(key, inputs, params):
+            return
+        for j in inputs:
+            if not os.path.exists(j):
+                raise IOError("{0} needs the missing file {1}".format(key, j))
+        code = func(*args)
+        names = outputs()
+        if code != 0:
+            raise RuntimeError("{0} failed with exit status {1}".format(key, code))
+        missing = [j for j in names if not os.path.exists(j)]
+        if missing:
+            raise RuntimeError("{0} did not write {1}".format(key, ", ".join(missing)))
+        self.record(key, inputs, params, names)
+
+
+def mask_file(item):
+    """Mask one image
+
+    Args:
+        item (Series): image
 
-def inner_calsky(item):
+    Returns:
+        code (int): exit status
+    """
     if item["inst"] == "WFC3":
-        wfc3_calsky(item)
+        return instrument.call(
+            "wfc3mask " + item["img_name"] + " >> phot.log", shell=True
+        )
     elif item["inst"] == "ACS":
-        acs_calsky(item)
+        return instrument.call(
+            "acsmask " + item["img_name"] + " >> phot.log", shell=True
+        )
     elif item["inst"] == "WFPC2":
-        wfpc2_calsky(item)
+        return instrument.call(
+            "wfpc2mask "
+            + item["img_name"]
+            + " "
+            + re.sub("c0m", "c1m", item["img_name"])
+            + " >> phot.log",
+            shell=True,
+        )
 
 
-def calsky_files(df):
-    """calsky the files
+def split_file(item):
+    """Split one image into chips
 
     Args:
-        df (DataFrame): data frame
+        item (Series): image
 
+    Returns:
+        code (int): exit status
     """
-    print("Calculating sky ...")
-    with Pool(len(df)) as p:
-        with tqdm(total=len(df)) as pbar:
-            for i in tqdm(
-                enumerate(
-                    p.imap_unordered(inner_calsky, [df.iloc[i] for i in range(len(df))])
-                )
-            ):
-                pbar.update()
+    return instrument.call(
+        "splitgroups " + item["img_name"] + " >> phot.log", shell=True
+    )
 
 
-def wfc3_calsky(item):
-    """Calsky parameter for WFC3
+def split_chips(item):
+    """Chips produced by splitting one image
+
+    Only the first chip of the reference is used.
 
     Args:
-        item (item): item
+        item (Series): image
+
+    Returns:
+        chips (list): chip numbers
     """
     if item["type"] == "reference":
-        if item["detect"] == "UVIS":
-            subprocess.call(
-                "calcsky "
-                + item["img_name"].replace(".fits", ".chip1")
-                + "  15 35 4 2.25 2.00 >> phot1.log",
-                shell=True,
-            )
-        else:
-            subprocess.call(
-                "calcsky "
-                + item["img_name"].replace(".fits", ".chip1")
-                + "  10 25 2 2.25 2.00 >> phot1.log",
-                shell=True,
-            )
-    else:
-        if item["detect"] == "UVIS":
-            subprocess.call(
-                "calcsky "
-                + item["img_name"].replace(".fits", ".chip1")
-                + "  15 35 4 2.25 2.00 >> phot1.log",
-                shell=True,
-            )
-            subprocess.call(
-                "calcsky "
-                + item["img_name"].replace(".fits", ".chip2")
-                + "  15 35 4 2.25 2.00 >> phot2.log",
-                shell=True,
-            )
-        else:
-            subprocess.call(
-                "calcsky "
-                + item["img_name"].replace(".fits", ".chip1")
-                + "  10 25 2 2.25 2.00 >> phot1.log",
-                shell=True,
-            )
-            subprocess.call(
-                "calcsky "
-                + item["img_name"].replace(".fits", ".chip2")
-                + "  10 25 2 2.25 2.00 >> phot2.log",
-                shell=True,
-            )
+        return [1]
+    chip_names = glob.glob(item["img_name"].replace(".fits", ".chip[1-4].fits"))
+    return sorted(int(j.split(".chip")[-1][0]) for j in chip_names)
 
 
-def acs_calsky(item):
-    """Calsky parameter for ACS
+def calsky_params(item):
+    """Calsky parameters of one image
 
     Args:
-        item (item): item
+        item (Series): image
+
+    Returns:
+        params (string): calcsky parameters
     """
-    if item["type"] == "reference":
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip1")
-            + "  15 35 4 2.25 2.00 >> phot1.log",
-            shell=True,
-        )
-    else:
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip1")
-            + "  15 35 4 2.25 2.00 >> phot1.log",
-            shell=True,
-        )
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip2")
-            + "  15 35 4 2.25 2.00 >> phot2.log",
-            shell=True,
-        )
+    if item["inst"] == "WFPC2" or (item["inst"] == "WFC3" and item["detect"] != "UVIS"):
+        return "10 25 2 2.25 2.00"
+    return "15 35 4 2.25 2.00"
 
 
-def wfpc2_calsky(item):
-    """Calsky parameter for WFPC2
+def calsky_file(item, chip):
+    """Calsky one chip of one image
 
     Args:
-        item (item): item
+        item (Series): image
+        chip (int): chip number
+
+    Returns:
+        code (int): exit status
     """
-    if item["type"] == "reference":
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip1")
-            + "  10 25 2 2.25 2.00 >> phot1.log",
-            shell=True,
-        )
-    else:
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip1")
-            + "  10 25 2 2.25 2.00 >> phot1.log",
-            shell=True,
-        )
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip2")
-            + "  10 25 2 2.25 2.00 >> phot2.log",
-            shell=True,
-        )
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip3")
-            + "  10 25 2 2.25 2.00 >> phot3.log",
-            shell=True,
-        )
-        subprocess.call(
-            "calcsky "
-            + item["img_name"].replace(".fits", ".chip4")
-            + "  10 25 2 2.25 2.00 >> phot4.log",
-            shell=True,
-        )
+    return instrument.call(
+        "calcsky {0} {1} >> phot{2:d}.log".format(
+            item["img_name"].replace(".fits", ".chip{0:d}".format(chip)),
+            calsky_params(item),
+            chip,
+        ),
+        shell=True,
+    )
+
+
+class TaskGraph:
+    """Dependency graph of tasks run by a bounded number of workers
+
+    Each task is dispatched as soon as all its dependencies are done. The
+    callback of a finished task runs in the main thread and may add new
+    tasks to the graph.
+
+    Args:
+        core (int): number of workers
+    """
+
+    def __init__(self, core):
+        self.core = max(1, core)
+        self.tasks = dict()
+        self.done = set()
+
+    def add(self, key, func, args=(), deps=(), then=None):
+        """Add a task
+
+        Args:
+            key (tuple): task name
+            func (function): task function
+            args (tuple): arguments of func
+            deps (list): keys of the tasks to wait for
+            then (function): callback called with the key once finished
+        """
+        self.tasks[key] = {"func": func, "args": args, "deps": set(deps), "then": then}
+
+    def run(self):
+        """Run all the tasks until the graph is exhausted"""
+        pending = dict(self.tasks)
+        running = dict()
+        with ThreadPoolExecutor(self.core) as executor:
+            with tqdm(total=len(self.tasks)) as pbar:
+                while pending or running:
+                    for key in [
+                        k for k, v in pending.items() if v["deps"] <= self.done
+                    ]:
+                        if len(running) >= self.core:
+                            break
+                        task = pending.pop(key)
+                        running[executor.submit(task["func"], *task["args"])] = key
+                    if not running:
+                        raise RuntimeError(
+                            "Unresolved dependencies: {0}".format(sorted(pending))
+                        )
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        key = running.pop(future)
+                        future.result()
+                        self.done.add(key)
+                        pbar.set_description("{0} {1}".format(key[0], key[1]))
+                        pbar.update()
+                        then = self.tasks[key]["then"]
+                        if then is not None:
+                            new_keys = set(self.tasks)
+                            then(key)
+                            for new_key in set(self.tasks) - new_keys:
+                                pending[new_key] = self.tasks[new_key]
+                            pbar.total = len(self.tasks)
+                            pbar.refresh()
 
 
 def param_files(df, chip_num):
@@ -573,22 +823,394 @@ def prepare_dir():
                 print("Complete directory preperation")
 
 
-def inner_dol(chip):
-    subprocess.call(
-        ["dolphot", "output{0:d}".format(chip), "-pphot{0}.param".format(chip)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+def dol_name(chip, tile=None):
+    """Name of the dolphot run of one chip or one tile of a chip
+
+    Args:
+        chip (int): chip number
+        tile (int): tile index
+                    (None)
+
+    Returns:
+        name (string): suffix of the output and param files
+    """
+    if tile is None:
+        return "{0:d}".format(chip)
+    return "{0:d}.t{1:d}".format(chip, tile)
+
+
+def read_param(paramfile):
+    """Read a dolphot parameter file
+
+    Args:
+        paramfile (string): parameter file
+
+    Returns:
+        params (dictionary): parameter values as strings
+    """
+    params = dict()
+    with open(paramfile) as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                params[key.strip()] = value.strip()
+    return params
+
+
+class DolProgress:
+    """Log and progress of one dolphot run
+
+    Each line of the dolphot output is written to the log file and parsed
+    for the current pass, iteration and number of stars, which give the
+    progress bar and the estimated time left.
+
+    Args:
+        name (string): name of the run
+        paramfile (string): parameter file of the run
+        position (int): position of the progress bar
+    """
+
+    patterns = {
+        "pass": re.compile(r"\bpass\s*#?\s*(\d+)", re.I),
+        "iter": re.compile(r"\biter(?:ation)?s?\s*#?\s*(\d+)", re.I),
+        "stars": re.compile(r"(\d+)\s+(?:stars|objects)\b", re.I),
+    }
+
+    def __init__(self, name, paramfile, position):
+        params = read_param(paramfile)
+        self.npass = 1 + int(params.get("SecondPass", 0))
+        self.maxit = max(1, int(params.get("MaxIT", 25)))
+        self.status = {"pass": 1, "iter": 0, "stars": 0}
+        self.start = time.time()
+        self.shown = 0
+        self.log = open("dolphot{0}.log".format(name), "w")
+        self.pbar = tqdm(
+            total=100, desc="dolphot {0}".format(name), position=position, leave=False
+        )
+
+    def __call__(self, line):
+        self.log.write(line)
+        for key, pattern in self.patterns.items():
+            match = pattern.search(line)
+            if match:
+                self.status[key] = int(match.group(1))
+                if key == "pass":
+                    self.status["iter"] = 0
+        if time.time() - self.shown > 1:
+            self.shown = time.time()
+            self.show()
+
+    def show(self):
+        fraction = (
+            self.status["pass"] - 1 + min(self.status["iter"], self.maxit) / self.maxit
+        ) / self.npass
+        fraction = min(max(fraction, 0), 1)
+        elapsed = time.time() - self.start
+        if fraction > 0:
+            eta = "{0:.0f}s".format(elapsed * (1 - fraction) / fraction)
+        else:
+            eta = "?"
+        self.pbar.n = int(100 * fraction)
+        self.pbar.set_postfix_str(
+            "pass {0}/{1} stars {2} eta {3}".format(
+                self.status["pass"], self.npass, self.status["stars"], eta
+            )
+        )
+
+    def close(self):
+        self.log.close()
+        self.pbar.close()
+
+
+dol_positions = list()
+dol_lock = threading.Lock()
+
+
+def inner_dol(chip, tile=None):
+    """Run dolphot on one chip or one tile
+
+    The output is streamed into dolphot{name}.log and shown as a live
+    progress bar.
+
+    Args:
+        chip (int): chip number
+        tile (int): tile index
+                    (None)
+
+    Returns:
+        code (int): exit status
+    """
+    name = dol_name(chip, tile)
+    with dol_lock:
+        position = min(set(range(1, len(dol_positions) + 2)) - set(dol_positions))
+        dol_positions.append(position)
+    progress = DolProgress(name, "phot{0}.param".format(name), position)
+    try:
+        return instrument.call(
+            ["dolphot", "output{0}".format(name), "-pphot{0}.param".format(name)],
+            stream=progress,
+        )
+    finally:
+        progress.close()
+        with dol_lock:
+            dol_positions.remove(position)
+
+
+def tile_regions(ref_file, ntile, overlap):
+    """Split the reference frame into overlapping tiles
 
+    The tiles form a grid as close to square as possible. Each tile has an
+    interior, which the tiles partition, and a region, which is the
+    interior grown by the overlap on every side.
 
-def run_dol(chip_num):
-    print("Running dolphot ...")
-    with Pool(chip_num) as p:
-        with tqdm(total=chip_num) as pbar:
-            for i in tqdm(
-                enumerate(p.imap_unordered(inner_dol, range(1, chip_num + 1)))
-            ):
-                pbar.update()
+    Args:
+        ref_file (string): reference chip file
+        ntile (int): number of tiles
+        overlap (int): overlap in pixels
+
+    Returns:
+        tiles (list): (region, interior) of each tile, both as
+                      (xmin, xmax, ymin, ymax)
+    """
+    header = fits.getheader(ref_file, 0)
+    nx = header["NAXIS1"]
+    ny = header["NAXIS2"]
+    tile_x = int(np.sqrt(ntile))
+    while ntile % tile_x:
+        tile_x -= 1
+    tile_y = ntile // tile_x
+    if nx > ny:
+        tile_x, tile_y = tile_y, tile_x
+    x_edges = np.linspace(0, nx, tile_x + 1).astype(int)
+    y_edges = np.linspace(0, ny, tile_y + 1).astype(int)
+    tiles = list()
+    for j in range(tile_y):
+        for i in range(tile_x):
+            region = (
+                max(0, x_edges[i] - overlap),
+                min(nx, x_edges[i + 1] + overlap),
+                max(0, y_edges[j] - overlap),
+                min(ny, y_edges[j + 1] + overlap),
+            )
+            interior = (
+                x_edges[i] if i > 0 else -np.inf,
+                x_edges[i + 1] if i < tile_x - 1 else np.inf,
+                y_edges[j] if j > 0 else -np.inf,
+                y_edges[j + 1] if j < tile_y - 1 else np.inf,
+            )
+            tiles.append((region, interior))
+    return tiles
+
+
+def tile_param_files(chip, tiles):
+    """Generate the parameter file of each tile from the chip's one
+
+    Args:
+        chip (int): chip number
+        tiles (list): tiles from tile_regions
+    """
+    with open("phot{0:d}.param".format(chip)) as f:
+        params = f.read()
+    for k, (region, interior) in enumerate(tiles):
+        with open("phot{0}.param".format(dol_name(chip, k)), "w") as f:
+            f.write(params)
+            f.write("xmin = {0:d}\n".format(int(region[0])))
+            f.write("xmax = {0:d}\n".format(int(region[1])))
+            f.write("ymin = {0:d}\n".format(int(region[2])))
+            f.write("ymax = {0:d}\n".format(int(region[3])))
+
+
+def merge_tiles(chip, tiles):
+    """Merge the outputs of the tiles into output{chip}
+
+    A star is kept only from the tile whose interior contains it, so the
+    stars in the overlaps are not duplicated. The other output files of the
+    chip are taken from the first tile.
+
+    Args:
+        chip (int): chip number
+        tiles (list): tiles from tile_regions
+
+    Returns:
+        code (int): exit status
+    """
+    data_name = "output{0:d}".format(chip)
+    with instrument.stage("merge"), open(data_name, "w") as fout:
+        for k, (region, interior) in enumerate(tiles):
+            with open("output{0}".format(dol_name(chip, k))) as fin:
+                for line in fin:
+                    items = line.split(None, 4)
+                    x = float(items[2])
+                    y = float(items[3])
+                    if (
+                        interior[0] <= x < interior[1]
+                        and interior[2] <= y < interior[3]
+                    ):
+                        fout.write(line)
+    for tile_name in glob.glob("output{0}.*".format(dol_name(chip, 0))):
+        shutil.copyfile(tile_name, tile_name.replace(dol_name(chip, 0), str(chip)))
+    return 0
+
+
+def chip_file(item, chip, suffix=".fits"):
+    """File name of one chip of one image
+
+    Args:
+        item (Series): image
+        chip (int): chip number
+        suffix (string): suffix
+                         (.fits)
+
+    Returns:
+        name (string): file name
+    """
+    return item["img_name"].replace(".fits", ".chip{0:d}{1}".format(chip, suffix))
+
+
+def run_pipeline(df, core, ntile=1, overlap=50, rawdir="raw/"):
+    """Mask, split, calsky and run dolphot as a task graph
+
+    The tasks are mask(image), split(image), calsky(image, chip) and
+    dolphot(chip). dolphot of a chip starts once the sky of that chip is
+    ready in every image, regardless of the other chips. Tasks that are up
+    to date in the checkpoint journal are skipped.
+
+    With more than one tile, dolphot of a chip is split into overlapping
+    tiles of the reference frame, followed by merge(chip).
+
+    Args:
+        df (DataFrame): data frame
+        core (int): number of workers
+        ntile (int): number of tiles per chip
+                     (1)
+        overlap (int): overlap between tiles in pixels
+                       (50)
+        rawdir (string): raw folder
+                         (raw/)
+    """
+    print("Running mask, split, calsky and dolphot ...")
+    graph = TaskGraph(core)
+    checkpoint = Checkpoint()
+    items = {df.iloc[i]["img_name"]: df.iloc[i] for i in range(len(df))}
+    ref_sky = list()
+    chip_sky = dict()
+    staged = list()
+    ref_item = df[df["type"] == "reference"].iloc[0]
+
+    def add_dolphot():
+        chip_num = check_chip_num(df)
+        param_files(df, chip_num)
+        for chip in range(1, 1 + chip_num):
+            inputs = list()
+            for item in [ref_item] + [
+                j for j in items.values() if j["type"] == "image"
+            ]:
+                ref_chip = 1 if item["type"] == "reference" else chip
+                inputs.append(chip_file(item, ref_chip))
+                inputs.append(chip_file(item, ref_chip, ".sky.fits"))
+            deps = ref_sky + chip_sky.get(chip, [])
+            if ntile <= 1:
+                add_dol_task(chip, None, inputs, deps)
+                continue
+            tiles = tile_regions(chip_file(ref_item, 1), ntile, overlap)
+            tile_param_files(chip, tiles)
+            for k in range(len(tiles)):
+                add_dol_task(chip, k, inputs, deps)
+            graph.add(
+                ("merge", chip),
+                checkpoint.run,
+                (
+                    "merge {0:d}".format(chip),
+                    merge_tiles,
+                    (chip, tiles),
+                    ["output{0}".format(dol_name(chip, k)) for k in range(len(tiles))],
+                    {"tiles": [[list(map(float, j)) for j in tile] for tile in tiles]},
+                    lambda chip=chip: [
+                        "output{0:d}".format(chip),
+                        "output{0:d}.columns".format(chip),
+                    ],
+                ),
+                deps=[("dolphot", dol_name(chip, k)) for k in range(len(tiles))],
+            )
+
+    def add_dol_task(chip, tile, inputs, deps):
+        name = dol_name(chip, tile)
+        graph.add(
+            ("dolphot", name),
+            checkpoint.run,
+            (
+                "dolphot {0}".format(name),
+                inner_dol,
+                (chip, tile),
+                ["phot{0}.param".format(name)] + inputs,
+                dict(),
+                lambda name=name: [
+                    "output{0}".format(name),
+                    "output{0}.columns".format(name),
+                ],
+            ),
+            deps=deps,
+        )
+
+    def add_calsky(key):
+        item = items[key[1]]
+        for chip in split_chips(item):
+            sky_key = ("calsky", "{0}[{1:d}]".format(key[1], chip))
+            graph.add(
+                sky_key,
+                checkpoint.run,
+                (
+                    "calsky {0}".format(chip_file(item, chip)),
+                    calsky_file,
+                    (item, chip),
+                    [chip_file(item, chip)],
+                    {"calcsky": calsky_params(item)},
+                    lambda item=item, chip=chip: [chip_file(item, chip, ".sky.fits")],
+                ),
+                deps=[key],
+            )
+            if item["type"] == "reference":
+                ref_sky.append(sky_key)
+            else:
+                chip_sky.setdefault(chip, []).append(sky_key)
+        if all(("split", j) in graph.done for j in items):
+            add_dolphot()
+
+    for img_name, item in items.items():
+        graph.add(
+            ("mask", img_name),
+            checkpoint.run,
+            (
+                "mask {0}".format(img_name),
+                load_mask_file,
+                (item, rawdir, staged),
+                ["{0}/{1}".format(rawdir, j) for j in raw_names(item)],
+                {"inst": item["inst"]},
+                lambda item=item: raw_names(item),
+            ),
+        )
+        graph.add(
+            ("split", img_name),
+            checkpoint.run,
+            (
+                "split {0}".format(img_name),
+                split_file,
+                (item,),
+                [img_name],
+                dict(),
+                lambda item=item: [chip_file(item, j) for j in split_chips(item)],
+            ),
+            deps=[("mask", img_name)],
+            then=add_calsky,
+        )
+    graph.run()
+    if staged:
+        print(
+            "Staged {0:d} files: {1}".format(
+                len(staged),
+                ", ".join("{0} {1}".format(v, k) for k, v in Counter(staged).items()),
+            )
+        )
 
 
 def print_info(df):
@@ -618,23 +1240,41 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--info", action="store_true", help="Print info (False)")
     parser.add_argument("--force", action="store_true", help="Force (False)")
+    parser.add_argument(
+        "-c", type=int, default=os.cpu_count(), help="Number of cores (all)"
+    )
+    parser.add_argument(
+        "--fresh", action="store_true", help="Ignore the checkpoints (False)"
+    )
+    parser.add_argument(
+        "-t", "--tile", type=int, default=1, help="Number of tiles per chip (1)"
+    )
+    parser.add_argument(
+        "--overlap", type=int, default=50, help="Overlap of tiles in pixels (50)"
+    )
+    parser.add_argument("--trace", help="Save a trace of the run to file (None)")
     args = parser.parse_args()
     force = args.force
     info = args.info
+    core = args.c
+    fresh = args.fresh
+    ntile = args.tile
+    overlap = args.overlap
+    if args.trace:
+        instrument.enable(args.trace)
 
     if info:
         ref_file = glob.glob("*drz.fits")[0]
-        df = gen_frame(ref_file)
+        with instrument.stage("gen_frame"):
+            df = gen_frame(ref_file)
         print_info(df)
 
     else:
         prepare_dir()
         ref_file = extract_ref(force)
-        df = gen_frame(ref_file)
-        load_files(df)
-        mask_files(df)
-        split_files(df)
-        chip_num = check_chip_num(df)
-        calsky_files(df)
-        param_files(df, chip_num)
-        run_dol(chip_num)
+        with instrument.stage("gen_frame"):
+            df = gen_frame(ref_file)
+        if fresh:
+            clean_files()
+        run_pipeline(df, core, ntile, overlap)
+    instrument.finish()
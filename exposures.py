@@ -0,0 +1,318 @@
+import os
+import re
+import json
+import zlib
+import shutil
+import argparse
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from astropy.table import Table
+
+import catalog
+
+index_name = "index.json"
+image_pattern = re.compile(r"^\d+\.\s*(.*?),\s*(\S+\.chip\d+)\s*\((.*)\)\s*$")
+
+
+def read_image_columns(columns_name):
+    """Read the per-image blocks from output.columns
+
+    Args:
+        columns_name (string): columns file
+
+    Returns:
+        images (OrderedDict): image name, without the chip -> (filter, exposure)
+        columns (OrderedDict): (image, quantity) -> column index
+    """
+    df_column = pd.read_csv(columns_name, names=["column"], sep="\t")
+    images = OrderedDict()
+    columns = OrderedDict()
+    for i, column in enumerate(df_column["column"]):
+        match = image_pattern.match(column)
+        if match is None:
+            continue
+        quantity, image, info = match.groups()
+        image = re.sub(r"\.chip\d+$", "", image)
+        images.setdefault(image, tuple(j.strip() for j in info.split(",")))
+        columns[(image, quantity)] = i
+    return images, columns
+
+
+class ImageStoreWriter:
+    """Write the per-image measurements into a chunked, compressed store
+
+    The store is a star x image x quantity float32 array cut into chunks
+    of star_chunk stars and image_chunk images, each saved as a zlib
+    compressed file. Reading one image or one star only decompresses the
+    chunks which contain it. The stars are appended in the order of
+    o.summary.fits and are NaN in the images of the other chips.
+
+    Args:
+        folder (string): output folder, replaced if it exists
+        images (OrderedDict): image name -> (filter, exposure)
+        quantities (list): quantity names
+        star_chunk (int): number of stars per chunk
+                          (4096)
+        image_chunk (int): number of images per chunk
+                           (16)
+    """
+
+    def __init__(self, folder, images, quantities, star_chunk=4096, image_chunk=16):
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        self.folder = folder
+        self.images = images
+        self.quantities = list(quantities)
+        self.star_chunk = star_chunk
+        self.image_chunk = image_chunk
+        self.buffer = np.full(
+            (star_chunk, len(images), len(self.quantities)), np.nan, np.float32
+        )
+        self.filled = 0
+        self.stars = 0
+
+    def write(self, data, columns):
+        """Append stars
+
+        Args:
+            data (dictionary): (image, quantity) -> array
+            columns (iterable): (image, quantity) keys in data
+        """
+        columns = list(columns)
+        rows = len(data[columns[0]])
+        image_index = {k: n for n, k in enumerate(self.images)}
+        quantity_index = {k: n for n, k in enumerate(self.quantities)}
+        start = 0
+        while start < rows:
+            size = min(rows - start, self.star_chunk - self.filled)
+            target = self.buffer[self.filled : self.filled + size]
+            for image, quantity in columns:
+                target[:, image_index[image], quantity_index[quantity]] = data[
+                    (image, quantity)
+                ][start : start + size]
+            self.filled += size
+            start += size
+            if self.filled == self.star_chunk:
+                self.flush()
+
+    def flush(self):
+        """Save the buffered stars as one row of chunks"""
+        if self.filled == 0:
+            return
+        chunk = self.stars // self.star_chunk
+        for n, start in enumerate(range(0, len(self.images), self.image_chunk)):
+            block = self.buffer[: self.filled, start : start + self.image_chunk]
+            file_name = os.path.join(self.folder, "{0:d}_{1:d}.zlib".format(chunk, n))
+            with open(file_name, "wb") as f:
+                f.write(zlib.compress(np.ascontiguousarray(block).tobytes(), 1))
+        self.stars += self.filled
+        self.filled = 0
+        self.buffer[:] = np.nan
+
+    def close(self):
+        """Save the last stars and write the index"""
+        self.flush()
+        index = {
+            "shape": [self.stars, len(self.images), len(self.quantities)],
+            "chunks": [self.star_chunk, self.image_chunk],
+            "dtype": "<f4",
+            "images": [[k] + list(v) for k, v in self.images.items()],
+            "quantities": self.quantities,
+        }
+        with open(os.path.join(self.folder, index_name), "w") as f:
+            json.dump(index, f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_image_store(folder, chip_num, quantities=None, chunksize=100000):
+    """Extract the per-image measurements of output{chip} into a store
+
+    Only the per-image columns of the selected quantities are parsed.
+
+    Args:
+        folder (string): output folder
+        chip_num (int): number of chips
+        quantities (list): quantities to keep, all by default
+                           (None)
+        chunksize (int): number of rows parsed at a time
+                         (100000)
+    """
+    chip_columns = list()
+    images = OrderedDict()
+    all_quantities = list()
+    for chip in range(1, 1 + chip_num):
+        chip_images, columns = read_image_columns("output{0:d}.columns".format(chip))
+        for k, v in chip_images.items():
+            images.setdefault(k, v)
+        for image, quantity in columns:
+            if quantity not in all_quantities:
+                all_quantities.append(quantity)
+        chip_columns.append(columns)
+    if quantities is None:
+        quantities = all_quantities
+    unknown = set(quantities) - set(all_quantities)
+    if unknown:
+        raise ValueError("Unknown quantities: {0}".format(", ".join(sorted(unknown))))
+
+    with ImageStoreWriter(folder, images, quantities) as writer:
+        for chip, columns in zip(range(1, 1 + chip_num), chip_columns):
+            columns = OrderedDict(
+                (k, v) for k, v in columns.items() if k[1] in quantities
+            )
+            for data in catalog.iter_output(
+                "output{0:d}".format(chip), columns, chunksize, np.float32
+            ):
+                writer.write(data, columns)
+    print(
+        "Saved {0:d} stars x {1:d} images x {2:d} quantities to {3}".format(
+            writer.stars, len(images), len(quantities), folder
+        )
+    )
+
+
+class ImageStore:
+    """Read a store written by ImageStoreWriter
+
+    Args:
+        folder (string): store folder
+        cache (int): number of decompressed chunks kept in memory
+                     (64)
+    """
+
+    def __init__(self, folder, cache=64):
+        self.folder = folder
+        with open(os.path.join(folder, index_name)) as f:
+            index = json.load(f)
+        self.shape = tuple(index["shape"])
+        self.star_chunk, self.image_chunk = index["chunks"]
+        self.dtype = np.dtype(index["dtype"])
+        self.images = OrderedDict((j[0], tuple(j[1:])) for j in index["images"])
+        self.image_names = list(self.images)
+        self.quantities = index["quantities"]
+        self.cache = OrderedDict()
+        self.cache_size = cache
+
+    def chunk(self, i, j):
+        """Decompress one chunk
+
+        Args:
+            i (int): star chunk
+            j (int): image chunk
+
+        Returns:
+            block (array): stars x images x quantities
+        """
+        if (i, j) in self.cache:
+            self.cache.move_to_end((i, j))
+            return self.cache[(i, j)]
+        stars = min(self.star_chunk, self.shape[0] - i * self.star_chunk)
+        images = min(self.image_chunk, self.shape[1] - j * self.image_chunk)
+        with open(
+            os.path.join(self.folder, "{0:d}_{1:d}.zlib".format(i, j)), "rb"
+        ) as f:
+            block = np.frombuffer(zlib.decompress(f.read()), self.dtype).reshape(
+                stars, images, self.shape[2]
+            )
+        self.cache[(i, j)] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return block
+
+    def image_index(self, image):
+        if isinstance(image, str):
+            return self.image_names.index(image)
+        return int(image)
+
+    def quantity_index(self, quantities):
+        if quantities is None:
+            return list(range(self.shape[2]))
+        if isinstance(quantities, str):
+            quantities = [quantities]
+        return [self.quantities.index(j) for j in quantities]
+
+    def star(self, index, quantities=None):
+        """Measurements of one star in every image, e.g. its light curve
+
+        Args:
+            index (int): row of the star in o.summary.fits
+            quantities (string or list): quantities, all by default
+                                         (None)
+
+        Returns:
+            t (Table): one row per image
+        """
+        q = self.quantity_index(quantities)
+        i, row = divmod(index, self.star_chunk)
+        values = np.concatenate(
+            [
+                self.chunk(i, j)[row][:, q]
+                for j in range(-(-self.shape[1] // self.image_chunk))
+            ]
+        )
+        t = Table()
+        t["image"] = self.image_names
+        t["filter"] = [j[0] for j in self.images.values()]
+        t["exposure"] = [j[1] if len(j) > 1 else "" for j in self.images.values()]
+        for n, k in enumerate(q):
+            t[self.quantities[k]] = values[:, n]
+        return t
+
+    def image(self, image, quantities=None):
+        """Measurements of every star in one image
+
+        Args:
+            image (string or int): image name or index
+            quantities (string or list): quantities, all by default
+                                         (None)
+
+        Returns:
+            t (Table): one row per star, in the order of o.summary.fits
+        """
+        q = self.quantity_index(quantities)
+        j, column = divmod(self.image_index(image), self.image_chunk)
+        values = (
+            np.concatenate(
+                [
+                    self.chunk(i, j)[:, column][:, q]
+                    for i in range(-(-self.shape[0] // self.star_chunk))
+                ]
+            )
+            if self.shape[0]
+            else np.zeros((0, len(q)), self.dtype)
+        )
+        return Table(
+            [values[:, n] for n in range(len(q))],
+            names=[self.quantities[k] for k in q],
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i", "--input", default="final/o.images", help="Per-image store"
+    )
+    parser.add_argument("-o", "--output", default="images.fits", help="Output")
+    parser.add_argument("--star", type=int, help="Row of a star in o.summary.fits")
+    parser.add_argument("--image", help="Image name")
+    parser.add_argument("-q", "--quantity", nargs="+", help="Quantities (all)")
+    args = parser.parse_args()
+
+    store = ImageStore(args.input)
+    print("{0:d} stars x {1:d} images x {2:d} quantities".format(*store.shape))
+    if args.star is not None:
+        store.star(args.star, args.quantity).write(args.output, overwrite=True)
+    elif args.image is not None:
+        store.image(args.image, args.quantity).write(args.output, overwrite=True)
+    else:
+        print("\n".join(store.image_names))
+        print("\n".join(store.quantities))
@@ -1,12 +1,13 @@
 import os
+import sys
 import glob
+import shutil
 import pickle
 import random
 import argparse
 import subprocess
 
 from collections import Counter
-from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -16,6 +17,12 @@ from tqdm import tqdm
 from astropy.io import fits
 from astropy.table import Table
 
+import calibrate
+import journal
+import instrument
+import placement
+import scheduler
+
 
 def generate_fakelist(df, chip, fake_num, filter_list, folder):
     """Generate the fakelist
@@ -35,6 +42,31 @@ def generate_fakelist(df, chip, fake_num, filter_list, folder):
             f.write("\n")
 
 
+def save_fake_ids(ids, folder):
+    """Save the ID -> (chip, run, row) table of the fake stars
+
+    The ID of a fake star is its row in the fake star file. The table is
+    sorted by chip, run and row, as the fake lists are written.
+
+    Args:
+        ids (list): (id, chip, run) arrays of each fake list
+        folder (string): output folder
+    """
+    table = np.zeros(
+        sum(len(j[0]) for j in ids),
+        dtype=[("id", "<i8"), ("chip", "i1"), ("run", "<i4"), ("row", "<i4")],
+    )
+    start = 0
+    for fake_id, chip, run in ids:
+        end = start + len(fake_id)
+        table["id"][start:end] = fake_id
+        table["chip"][start:end] = chip
+        table["run"][start:end] = run
+        table["row"][start:end] = np.arange(len(fake_id))
+        start = end
+    np.save("{0}/ids.npy".format(folder), table)
+
+
 def generate_fake_param(chip, folder):
     """Generate parameter file for fake star
     
@@ -50,6 +82,275 @@ def generate_fake_param(chip, folder):
         f.write("FakeMatch=3.0\n")
 
 
+def dolphot_command(chip, folder, index, list_folder=None, suffix=""):
+    """DOLPHOT command of one fake star run
+
+    Args:
+        chip (int): chip number
+        folder (string): output folder, which names the parameter file
+        index (int): fake index
+        list_folder (string): folder of the fake list and output, folder
+                              by default
+                              (None)
+        suffix (string): appended to the output name, e.g. for a temporary
+                         output
+                         ("")
+
+    Returns:
+        args (list): command
+    """
+    if list_folder is None:
+        list_folder = folder
+    return [
+        "dolphot",
+        "output{0}".format(chip),
+        "-pphot{0:d}.{1}.param".format(chip, folder),
+        "FakeStars={0}/fake{1:d}.list{2:0>4}".format(list_folder, chip, index),
+        "FakeOut={0}/output{1:d}.fake{2:0>4}{3}".format(
+            list_folder, chip, index, suffix
+        ),
+    ]
+
+
+def log_name(folder, chip, index):
+    """DOLPHOT log of a fake star run, kept only if the run fails"""
+    return "{0}/log/output{1:d}.fake{2:0>4}.log".format(folder, chip, index)
+
+
+def split_runs(df_chip, separation, run):
+    """Split the fake stars of a chip into runs
+
+    Args:
+        df_chip (DataFrame): fake stars of the chip
+        separation (float): min distance of the stars in a run in pixels, 0
+                            to take the stars in order
+        run (int): number of fake stars per run
+
+    Returns:
+        runs (list): row arrays of the stars of each run
+    """
+    if separation > 0:
+        return placement.pack_runs(df_chip["X"], df_chip["Y"], separation, run)
+    fake_num = int(len(df_chip) / run)
+    return [np.arange(i * run, (i + 1) * run) for i in range(fake_num)]
+
+
+def probe_dolphot(chip, folder, df_probe, filter_list, sizes):
+    """Time DOLPHOT on fake lists of a few sizes
+
+    The probes are run one at a time in folder/probe, which is removed
+    afterwards. A probe which fails is left out of the results.
+
+    Args:
+        chip (int): chip number
+        folder (string): output folder
+        df_probe (DataFrame): fake stars to draw the lists from
+        filter_list (list): filter list
+        sizes (list): number of fake stars of each probe
+
+    Returns:
+        done (list): number of fake stars of each successful probe
+        walls (list): wall time of each successful probe in seconds
+        rss (list): peak RSS of each successful probe in bytes
+    """
+    probe_folder = os.path.join(folder, "probe")
+    os.makedirs(probe_folder, exist_ok=True)
+    done = list()
+    walls = list()
+    rss = list()
+    for size in sizes:
+        generate_fakelist(df_probe.iloc[:size], chip, size, filter_list, probe_folder)
+        code, wall, peak = instrument.measure(
+            dolphot_command(chip, folder, size, probe_folder),
+            name="dolphot probe",
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if code != 0:
+            print("Probe of chip {0:d} exited with {1:d}".format(chip, code))
+            continue
+        print(
+            "Probe of chip {0:d} with {1:d} stars: {2:.1f} s, {3:.0f} MB".format(
+                chip, size, wall, peak / 2**20
+            )
+        )
+        done.append(size)
+        walls.append(wall)
+        rss.append(peak)
+    shutil.rmtree(probe_folder)
+    return done, walls, rss
+
+
+def calibrate_runs(df, folder, filter_list, separations, max_run, cores, memory, sizes):
+    """Choose the run size of each chip and the number of processes
+
+    DOLPHOT is timed on probe lists of each chip, unless the calibration of
+    the same phot{chip}.param is recorded in fake.calibration.json. The
+    processes are as many as fit in the cores and the memory, and the run
+    size minimizes the wall time of the chip, up to max_run stars, or to
+    the largest packed run with a separation. If fewer than two probes of
+    a chip succeed, a RuntimeError is raised and nothing is recorded.
+
+    Args:
+        df (DataFrame): fake stars
+        folder (string): output folder
+        filter_list (list): filter list
+        separations (dictionary): chip -> min distance of the stars in a run
+        max_run (int): largest run without a separation
+        cores (int): number of cores
+        memory (int): memory budget in bytes, None for no limit
+        sizes (list): number of fake stars of each probe
+
+    Returns:
+        runs (dictionary): chip -> number of fake stars per run
+        workers (int): number of processes
+    """
+    record = calibrate.load_calibration()
+    models = dict()
+    for chip, separation in separations.items():
+        df_chip = df[df.chip == chip]
+        if separation > 0:
+            stars = max(split_runs(df_chip, separation, len(df_chip)), key=len)
+        else:
+            stars = np.arange(min(max_run, len(df_chip)))
+        digest = calibrate.param_hash("phot{0:d}.param".format(chip))
+        model = record.get(str(chip))
+        if model is None or model["param"] != digest:
+            probe = sorted(set(min(j, len(stars)) for j in sizes))
+            needed = min(2, len(probe))
+            probe, walls, rss = probe_dolphot(
+                chip, folder, df_chip.iloc[stars], filter_list, probe
+            )
+            if len(probe) < needed:
+                raise RuntimeError(
+                    "Too few probes of chip {0:d} succeeded to calibrate".format(chip)
+                )
+            startup, per_star = calibrate.fit_cost(probe, walls)
+            model = {
+                "param": digest,
+                "sizes": probe,
+                "walls": walls,
+                "rss": rss,
+                "startup": startup,
+                "per_star": per_star,
+            }
+        else:
+            print(
+                "Use the calibration of chip {0:d} in {1}".format(
+                    chip, calibrate.calibration_name
+                )
+            )
+        model["max_run"] = len(stars)
+        models[chip] = model
+
+    workers = calibrate.choose_workers(
+        cores, memory, max(max(j["rss"]) for j in models.values())
+    )
+    runs = dict()
+    for chip, model in models.items():
+        runs[chip], wall = calibrate.choose_run(
+            int(np.sum(df.chip == chip)),
+            workers,
+            model["startup"],
+            model["per_star"],
+            model["max_run"],
+        )
+        model.update(run=runs[chip], workers=workers, wall=wall)
+        print(
+            "Chip {0:d}: {1:.2f} s per run + {2:.4f} s per star, "
+            "{3:d} stars per run on {4:d} processes, about {5:.0f} s".format(
+                chip, model["startup"], model["per_star"], runs[chip], workers, wall
+            )
+        )
+    record.update((str(k), v) for k, v in models.items())
+    calibrate.save_calibration(record)
+    return runs, workers
+
+
+def run_fake(folder, list_names, core, memory):
+    """Run DOLPHOT on the fake lists within a memory budget
+
+    The peak RSS of a run of each chip is first estimated from the images
+    in phot{chip}.{folder}.param, or taken from the probes recorded in
+    fake.calibration.json, and then from the runs which have finished.
+    Each run writes its output to a temporary file, renamed only once
+    DOLPHOT succeeds, and its states are appended to the journal. The
+    output of DOLPHOT goes to folder/log, and is kept for the failed runs.
+
+    Args:
+        folder (string): output folder
+        list_names (list): fake list files
+        core (int): number of cores
+        memory (int): memory budget in bytes, None for no limit
+
+    Returns:
+        failed (int): number of runs which failed
+    """
+    record = calibrate.load_calibration()
+    log = journal.Journal(folder)
+    os.makedirs(os.path.join(folder, "log"), exist_ok=True)
+    estimates = dict()
+    tasks = list()
+    for list_name in sorted(list_names):
+        name = journal.parse_name(list_name, journal.list_pattern)
+        if name is None:
+            continue
+        chip, index = name
+        if chip not in estimates:
+            model = record.get(str(chip))
+            if model is not None and model["param"] == calibrate.param_hash(
+                "phot{0:d}.param".format(chip)
+            ):
+                estimates[chip] = max(model["rss"])
+            else:
+                estimates[chip] = scheduler.estimate_rss(
+                    "phot{0:d}.{1}.param".format(chip, folder)
+                )
+            print(
+                "Chip {0:d} needs about {1:.0f} MB per run".format(
+                    chip, estimates[chip] / 2**20
+                )
+            )
+        tasks.append(
+            (
+                chip,
+                name,
+                dolphot_command(chip, folder, index, suffix=".tmp"),
+                "dolphot",
+                {"log": log_name(folder, chip, index)},
+            )
+        )
+
+    def started(task):
+        log.record(journal.task_name(*task[1]), "running")
+
+    runner = scheduler.MemoryScheduler(core, memory, estimates)
+    failed = 0
+    with tqdm(total=len(tasks)) as pbar:
+        for task, code, wall, rss in runner.run(tasks, started):
+            output_name = "{0}/output{1:d}.fake{2:0>4}".format(folder, *task[1])
+            state = "failed"
+            if code == 0 and os.path.exists(output_name + ".tmp"):
+                os.replace(output_name + ".tmp", output_name)
+                os.remove(log_name(folder, *task[1]))
+                state = "done"
+            else:
+                if os.path.exists(output_name + ".tmp"):
+                    os.remove(output_name + ".tmp")
+                failed += 1
+            log.record(
+                journal.task_name(*task[1]), state, code=code, wall=wall, rss=rss
+            )
+            pbar.update()
+    if failed:
+        print(
+            "{0:d} of {1:d} runs failed, see {2} and {3}/log".format(
+                failed, len(tasks), log.file_name, folder
+            )
+        )
+    return failed
+
+
 def read_fits(file_name):
     """Read fits and sort by seed 1442291549
     
@@ -94,9 +395,33 @@ if __name__ == "__main__":
     parser.add_argument(
         "-r", "--run", type=int, default=100, help="Number of fake stars per run (100)"
     )
-    parser.add_argument("-c", type=int, default=30, help="Number of cores (30)")
+    parser.add_argument(
+        "-c", type=int, default=os.cpu_count(), help="Number of cores (all)"
+    )
     parser.add_argument("--force", action="store_true", help="Force (False)")
     parser.add_argument("--con", action="store_true", help="Continuum (False)")
+    parser.add_argument(
+        "--separation",
+        type=float,
+        default=0,
+        help="Min distance of the stars in a run in RPSF, 0 for no packing (0)",
+    )
+    parser.add_argument(
+        "--calibrate",
+        action="store_true",
+        help="Choose the run size and number of processes from probes (False)",
+    )
+    parser.add_argument(
+        "--probe",
+        type=int,
+        nargs="+",
+        default=[10, 50, 200],
+        help="Number of fake stars of each probe (10 50 200)",
+    )
+    parser.add_argument(
+        "--memory", type=float, help="Memory budget in GB (available memory)"
+    )
+    parser.add_argument("--trace", help="Save a trace of the run to file (None)")
     args = parser.parse_args()
     folder = args.file
     num_step = args.run
@@ -104,6 +429,13 @@ if __name__ == "__main__":
     con = args.con
     force = args.force
     file_name = "{0}.fits".format(folder)
+    if args.trace:
+        instrument.enable(args.trace)
+    failed = 0
+
+    memory = (
+        calibrate.memory_available() if args.memory is None else args.memory * 2**30
+    )
 
     if not os.path.exists(file_name):
         print("No {0} is found. Make sure the directory is correct.".format(file_name))
@@ -130,81 +462,98 @@ if __name__ == "__main__":
 
         if is_cal == "y":
             print("Reading ...")
-            df = read_fits(file_name)
+            with instrument.stage("read_fits"):
+                df = read_fits(file_name)
             filter_list = get_filters(df)
             chip_num = len(Counter(df.chip))
 
+            separations = dict()
             for chip in range(1, 1 + chip_num):
                 generate_fake_param(chip, folder)
+                rpsf = placement.read_rpsf("phot{0:d}.param".format(chip))
+                separations[chip] = 0
+                if args.separation > 0:
+                    if rpsf is None:
+                        print("No RPSF in phot{0:d}.param, split in order".format(chip))
+                    else:
+                        separations[chip] = args.separation * rpsf
+
+            run_size = {chip: num_step for chip in separations}
+            if args.calibrate:
+                run_size, core = calibrate_runs(
+                    df,
+                    folder,
+                    filter_list,
+                    separations,
+                    num_step,
+                    core,
+                    memory,
+                    args.probe,
+                )
 
+            ids = list()
+            for chip in range(1, 1 + chip_num):
                 print("Generating fake for chip {0:d} ...".format(chip))
                 df_chip = df[df.chip == chip]
-                fake_num = int(len(df_chip) / num_step)
-                for i in tqdm(range(fake_num)):
-                    df_sel = df_chip.iloc[i * num_step : (i + 1) * num_step]
-                    generate_fakelist(df_sel, chip, i, filter_list, folder)
+                runs = split_runs(df_chip, separations[chip], run_size[chip])
+                if separations[chip] > 0:
+                    print(
+                        "{0:d} runs with stars at least {1:.1f} px apart".format(
+                            len(runs), separations[chip]
+                        )
+                    )
+                with instrument.stage("generate_fakelist"):
+                    for i, run in enumerate(tqdm(runs)):
+                        df_sel = df_chip.iloc[run]
+                        generate_fakelist(df_sel, chip, i, filter_list, folder)
+                        ids.append((df_sel.index.to_numpy(), chip, i))
+            save_fake_ids(ids, folder)
+            journal.Journal(folder).append(
+                [
+                    {"task": journal.task_name(chip, i), "state": "pending"}
+                    for _, chip, i in ids
+                ]
+            )
 
             print("Running ...")
             output_names = glob.glob("{0}/fake*".format(folder))
-
-            def inner_dolphot(output_name):
-                chip = int(output_name.split("list")[0][-2])
-                index = int(output_name.split("list")[1])
-                subprocess.call(
-                    [
-                        "dolphot",
-                        "output{0}".format(chip),
-                        "-pphot{0:d}.{1}.param".format(chip, folder),
-                        "FakeStars={0}/fake{1:d}.list{2:0>4}".format(
-                            folder, chip, index
-                        ),
-                        "FakeOut={0}/output{1:d}.fake{2:0>4}".format(
-                            folder, chip, index
-                        ),
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-
-            with Pool(core) as p:
-                with tqdm(total=len(output_names)) as pbar:
-                    for i, _ in tqdm(
-                        enumerate(p.imap_unordered(inner_dolphot, output_names))
-                    ):
-                        pbar.update()
+            failed = run_fake(folder, output_names, core, memory)
         if con:
             print("Running ...")
-            output_names = list()
-            fake_names = glob.glob("{0}/output*".format(folder))
-            for output_name in glob.glob("{0}/fake*".format(folder)):
-                chip = int(output_name.split("list")[0][-2])
-                index = int(output_name.split("list")[1])
-                fake_name = "{0}/output{1:d}.fake{2:0>4}".format(folder, chip, index)
-                if fake_name not in fake_names:
-                    output_names.append(output_name)
-
-            def inner_dolphot(output_name):
-                chip = int(output_name.split("list")[0][-2])
-                index = int(output_name.split("list")[1])
-                subprocess.call(
-                    [
-                        "dolphot",
-                        "output{0}".format(chip),
-                        "-pphot{0:d}.{1}.param".format(chip, folder),
-                        "FakeStars={0}/fake{1:d}.list{2:0>4}".format(
-                            folder, chip, index
-                        ),
-                        "FakeOut={0}/output{1:d}.fake{2:0>4}".format(
-                            folder, chip, index
-                        ),
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
+            log = journal.Journal(folder)
+            list_names = list()
+            if log.exists():
+                tasks = log.read()
+                states = Counter(j["state"] for j in tasks.values())
+                print(
+                    "{0:d} done, {1:d} failed, {2:d} interrupted, {3:d} pending".format(
+                        states["done"],
+                        states["failed"],
+                        states["running"],
+                        states["pending"],
+                    )
                 )
-
-            with Pool(core) as p:
-                with tqdm(total=len(output_names)) as pbar:
-                    for i, _ in tqdm(
-                        enumerate(p.imap_unordered(inner_dolphot, output_names))
-                    ):
-                        pbar.update()
+            else:
+                print("No {0}, resume from the outputs found".format(log.file_name))
+            events = list()
+            for list_name in glob.glob("{0}/fake*".format(folder)):
+                name = journal.parse_name(list_name, journal.list_pattern)
+                if name is None:
+                    continue
+                fake_name = "{0}/output{1:d}.fake{2:0>4}".format(folder, *name)
+                if log.exists():
+                    event = tasks.get(journal.task_name(*name), {})
+                    if event.get("state") == "done" and os.path.exists(fake_name):
+                        continue
+                elif os.path.exists(fake_name):
+                    events.append({"task": journal.task_name(*name), "state": "done"})
+                    continue
+                list_names.append(list_name)
+            if events:
+                # start the journal with the outputs found, which photfake.py
+                # would skip otherwise
+                log.append(events)
+            failed = run_fake(folder, list_names, core, memory)
+    instrument.finish()
+    if failed:
+        sys.exit(1)
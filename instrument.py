@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import resource
+import threading
+import subprocess
+
+from contextlib import contextmanager
+from collections import OrderedDict
+
+TRACE_ENV = "PYDOLPHOT_TRACE"
+
+
+def enable(filename):
+    """Enable tracing into filename
+
+    The events are appended to filename.events as they happen, also by
+    the worker processes, which inherit the setting through the environment.
+    finish converts them into a Chrome trace (Perfetto) JSON file.
+
+    Args:
+        filename (string): trace file
+    """
+    os.environ[TRACE_ENV] = os.path.abspath(filename)
+    with open(events_name(), "w"):
+        pass
+
+
+def enabled():
+    """Whether the tracing is enabled
+
+    Returns:
+        enabled (boolean): tracing is enabled
+    """
+    return TRACE_ENV in os.environ
+
+
+def events_name():
+    return os.environ[TRACE_ENV] + ".events"
+
+
+def read_io(pid="self"):
+    """Read the bytes read and written by a process
+
+    Args:
+        pid (int or string): process id
+                             (self)
+
+    Returns:
+        read, write (int): bytes read and written, 0 if unavailable
+    """
+    try:
+        with open("/proc/{0}/io".format(pid)) as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def record(name, cat, start, wall, args):
+    """Append one event to the trace
+
+    Args:
+        name (string): task name
+        cat (string): category, tool or stage
+        start (float): start time in seconds since the epoch
+        wall (float): wall time in seconds
+        args (dictionary): measured resources
+    """
+    event = {
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": int(start * 1e6),
+        "dur": int(wall * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.get_ident() % 100000,
+        "args": args,
+    }
+    fd = os.open(events_name(), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, (json.dumps(event) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def call(args, name=None, stream=None, **kwargs):
+    """Run an external tool like subprocess.call and trace it
+
+    The peak RSS is the one reported by the kernel for the child, which
+    cannot be lower than the RSS of this process when it forked.
+
+    Args:
+        args (string or list): command
+        name (string): task name, the tool name by default
+                       (None)
+        stream (function): called with each line of the output, which is
+                           then read from a pipe (stderr included)
+                           (None)
+        kwargs: passed to subprocess.Popen
+
+    Returns:
+        code (int): exit status
+    """
+    if name is None:
+        tool = args.split()[0] if isinstance(args, str) else args[0]
+        name = os.path.basename(tool)
+    if stream is not None:
+        kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if not enabled():
+        with subprocess.Popen(args, **kwargs) as proc:
+            if stream is not None:
+                for line in proc.stdout:
+                    stream(line)
+            return proc.wait()
+
+    start = time.time()
+    proc = subprocess.Popen(args, **kwargs)
+    if stream is not None:
+        for line in proc.stdout:
+            stream(line)
+        proc.stdout.close()
+    os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+    read_bytes, write_bytes = read_io(proc.pid)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.time() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    record(
+        name,
+        "tool",
+        start,
+        wall,
+        {
+            "cmd": args if isinstance(args, str) else " ".join(map(str, args)),
+            "cpu": usage.ru_utime + usage.ru_stime,
+            "rss": usage.ru_maxrss * 1024,
+            "exit": proc.returncode,
+            "read": read_bytes,
+            "write": write_bytes,
+        },
+    )
+    return proc.returncode
+
+
+def measure(args, name=None, **kwargs):
+    """Run an external tool, measuring its wall time and peak RSS
+
+    Unlike call, the measurement does not need the tracing to be enabled,
+    which still records the run if it is. The output must not be piped
+    without being read.
+
+    Args:
+        args (string or list): command
+        name (string): task name, the tool name by default
+                       (None)
+        kwargs: passed to subprocess.Popen
+
+    Returns:
+        code (int): exit status
+        wall (float): wall time in seconds
+        rss (int): peak RSS in bytes
+    """
+    if name is None:
+        tool = args.split()[0] if isinstance(args, str) else args[0]
+        name = os.path.basename(tool)
+    start = time.time()
+    proc = subprocess.Popen(args, **kwargs)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.time() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if enabled():
+        record(
+            name,
+            "tool",
+            start,
+            wall,
+            {
+                "cmd": args if isinstance(args, str) else " ".join(map(str, args)),
+                "cpu": usage.ru_utime + usage.ru_stime,
+                "rss": usage.ru_maxrss * 1024,
+                "exit": proc.returncode,
+                "read": 0,
+                "write": 0,
+            },
+        )
+    return proc.returncode, wall, usage.ru_maxrss * 1024
+
+
+@contextmanager
+def stage(name):
+    """Trace a Python stage
+
+    CPU time and I/O are those of the whole process during the stage, and
+    rss is the peak of the process so far.
+
+    Args:
+        name (string): stage name
+    """
+    if not enabled():
+        yield
+        return
+    start = time.time()
+    cpu = time.process_time()
+    read_bytes, write_bytes = read_io()
+    status = 1
+    try:
+        yield
+        status = 0
+    finally:
+        wall = time.time() - start
+        read_end, write_end = read_io()
+        record(
+            name,
+            "stage",
+            start,
+            wall,
+            {
+                "cpu": time.process_time() - cpu,
+                "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                "exit": status,
+                "read": read_end - read_bytes,
+                "write": write_end - write_bytes,
+            },
+        )
+
+
+def finish():
+    """Write the trace file and print the summary table"""
+    if not enabled():
+        return
+    events = list()
+    with open(events_name()) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass
+    with open(os.environ[TRACE_ENV], "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.remove(events_name())
+
+    summary = OrderedDict()
+    for event in sorted(events, key=lambda j: j["ts"]):
+        row = summary.setdefault(
+            (event["cat"], event["name"]),
+            {"n": 0, "fail": 0, "wall": 0, "max": 0, "cpu": 0, "rss": 0, "io": 0},
+        )
+        wall = event["dur"] / 1e6
+        row["n"] += 1
+        row["fail"] += event["args"]["exit"] != 0
+        row["wall"] += wall
+        row["max"] = max(row["max"], wall)
+        row["cpu"] += event["args"]["cpu"]
+        row["rss"] = max(row["rss"], event["args"]["rss"])
+        row["io"] += event["args"]["read"] + event["args"]["write"]
+    header = "{0:<6} {1:<24} {2:>6} {3:>5} {4:>9} {5:>9} {6:>9} {7:>9} {8:>9}"
+    row_format = "{0:<6} {1:<24} {2:>6d} {3:>5d} {4:>9.1f} {5:>9.1f} {6:>9.1f} {7:>9.0f} {8:>9.0f}"
+    print(
+        header.format(
+            "type",
+            "name",
+            "count",
+            "fail",
+            "wall(s)",
+            "max(s)",
+            "cpu(s)",
+            "rss(MB)",
+            "io(MB)",
+        )
+    )
+    for (cat, name), row in summary.items():
+        print(
+            row_format.format(
+                cat,
+                name[:24],
+                row["n"],
+                row["fail"],
+                row["wall"],
+                row["max"],
+                row["cpu"],
+                row["rss"] / 2**20,
+                row["io"] / 2**20,
+            )
+        )
+    print("Trace saved to {0}".format(os.environ[TRACE_ENV]))
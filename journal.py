@@ -0,0 +1,101 @@
+import os
+import re
+import json
+import time
+
+journal_name = "journal.jsonl"
+list_pattern = re.compile(r"fake(\d+)\.list(\d+)$")
+output_pattern = re.compile(r"output(\d+)\.fake(\d+)$")
+
+
+def parse_name(name, pattern):
+    """Read the chip and the fake index from a file name
+
+    Args:
+        name (string): fake list or output file name
+        pattern (Pattern): list_pattern or output_pattern
+
+    Returns:
+        chip, index (int): chip and fake index, None if it does not match
+    """
+    match = pattern.search(os.path.basename(name))
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def task_name(chip, index):
+    return "{0:d}.{1:0>4}".format(chip, index)
+
+
+class Journal:
+    """Append-only journal of the fake star runs of a folder
+
+    Every change of state of a run (pending, running, done or failed) is
+    appended as one JSON line and synced to disk, so the journal survives
+    a crash of the node. A line cut by the crash is ignored when reading.
+
+    Args:
+        folder (string): fake star folder
+    """
+
+    states = ("pending", "running", "done", "failed")
+
+    def __init__(self, folder):
+        self.file_name = os.path.join(folder, journal_name)
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def append(self, events):
+        """Append events
+
+        Args:
+            events (list): dictionaries with task and state, and any other
+                           information such as code, wall or rss
+        """
+        lines = list()
+        for event in events:
+            if event["state"] not in self.states:
+                raise ValueError("Unknown state: {0}".format(event["state"]))
+            event = dict(event, time=time.time())
+            lines.append(json.dumps(event) + "\n")
+        data = "".join(lines).encode()
+        fd = os.open(self.file_name, os.O_RDWR | os.O_APPEND | os.O_CREAT)
+        try:
+            size = os.fstat(fd).st_size
+            # end a line cut by a crash, which is then skipped by read
+            if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                data = b"\n" + data
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def record(self, task, state, **info):
+        """Append one event
+
+        Args:
+            task (string): task name
+            state (string): pending, running, done or failed
+            info: other information of the event
+        """
+        self.append([dict(info, task=task, state=state)])
+
+    def read(self):
+        """Last event of every task
+
+        Returns:
+            tasks (dictionary): task name -> its last event
+        """
+        tasks = dict()
+        if not self.exists():
+            return tasks
+        with open(self.file_name) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                tasks[event["task"]] = event
+        return tasks
@@ -0,0 +1,429 @@
+import os
+import json
+import shutil
+import argparse
+
+import numpy as np
+
+from astropy.table import Table
+
+import catalog
+
+index_name = "index.json"
+
+
+def unwrap(ra, ra0):
+    """Put RA within 180 deg of ra0, so a field across RA = 0 is continuous
+
+    Args:
+        ra (float or array): RA in degrees
+        ra0 (float): RA of the field centre in degrees
+
+    Returns:
+        ra (float or array): RA in degrees within [ra0 - 180, ra0 + 180)
+    """
+    return ra0 + (np.asarray(ra) - ra0 + 180) % 360 - 180
+
+
+class PartitionWriter:
+    """Write a catalog partitioned by chip and by a regular RA/Dec grid
+
+    Each partition is a binary file of records, appended block by block,
+    and index.json records for each of them the number of rows, the RA
+    and Dec range and the range of every magnitude column, so a query only
+    opens the partitions it may need. The grid cells are square on the sky
+    with side tile arcsec at the field centre.
+
+    Args:
+        folder (string): output folder, replaced if it exists
+        dtype (list): (column name, dtype) of each column
+        center (tuple): (ra0, dec0) of the field centre in degrees
+        tile (float): grid cell size in arcsec
+    """
+
+    def __init__(self, folder, dtype, center, tile):
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        self.folder = folder
+        self.record = np.dtype(dtype)
+        self.ra0, self.dec0 = float(center[0]), float(center[1])
+        self.tile = float(tile)
+        self.mags = [j for j in self.record.names if j.endswith("_VEGA")]
+        self.partitions = dict()
+
+    def cell(self, ra, dec):
+        """Grid cell of sky positions
+
+        Args:
+            ra, dec (array): sky positions in degrees
+
+        Returns:
+            i, j (array): cell indices along RA and Dec
+        """
+        dx = (unwrap(ra, self.ra0) - self.ra0) * np.cos(np.deg2rad(self.dec0))
+        i = np.floor(dx * 3600 / self.tile).astype(np.int64)
+        j = np.floor((dec - self.dec0) * 3600 / self.tile).astype(np.int64)
+        return i, j
+
+    def write(self, data):
+        """Append rows to their partitions
+
+        Args:
+            data (dictionary): column name -> array, with chip, RA and DEC
+        """
+        rows = len(data["RA"])
+        if rows == 0:
+            return
+        rec = np.empty(rows, self.record)
+        for name in self.record.names:
+            rec[name] = data[name]
+        i, j = self.cell(rec["RA"], rec["DEC"])
+        keys = np.stack([rec["chip"].astype(np.int64), i, j], axis=1)
+        keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+        for n, key in enumerate(keys):
+            part = rec[order[bounds[n] : bounds[n + 1]]]
+            self.append(tuple(int(k) for k in key), part)
+
+    def append(self, key, part):
+        """Append records to one partition and update its ranges
+
+        Args:
+            key (tuple): (chip, i, j)
+            part (array): records
+        """
+        if key not in self.partitions:
+            self.partitions[key] = {
+                "file": "chip{0:d}_{1:d}_{2:d}.bin".format(*key),
+                "chip": key[0],
+                "cell": [key[1], key[2]],
+                "rows": 0,
+                "ra": [np.inf, -np.inf],
+                "dec": [np.inf, -np.inf],
+                "mag": {j: [np.inf, -np.inf] for j in self.mags},
+            }
+        entry = self.partitions[key]
+        with open(os.path.join(self.folder, entry["file"]), "ab") as f:
+            f.write(part.tobytes())
+        entry["rows"] += len(part)
+        ranges = [("ra", unwrap(part["RA"], self.ra0)), ("dec", part["DEC"])]
+        for name, values in ranges:
+            entry[name] = [
+                min(entry[name][0], float(values.min())),
+                max(entry[name][1], float(values.max())),
+            ]
+        for name in self.mags:
+            entry["mag"][name] = [
+                min(entry["mag"][name][0], float(part[name].min())),
+                max(entry["mag"][name][1], float(part[name].max())),
+            ]
+
+    def close(self):
+        """Write the index"""
+        index = {
+            "dtype": [(name, self.record[name].str) for name in self.record.names],
+            "center": [self.ra0, self.dec0],
+            "tile": self.tile,
+            "partitions": [self.partitions[k] for k in sorted(self.partitions)],
+        }
+        with open(os.path.join(self.folder, index_name + ".tmp"), "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(
+            os.path.join(self.folder, index_name + ".tmp"),
+            os.path.join(self.folder, index_name),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def separation(ra1, dec1, ra2, dec2):
+    """Angular separation (haversine)
+
+    Args:
+        ra1, dec1, ra2, dec2 (float or array): sky positions in degrees
+
+    Returns:
+        separation (float or array): separation in degrees
+    """
+    ra1, dec1, ra2, dec2 = map(np.deg2rad, (ra1, dec1, ra2, dec2))
+    a = (
+        np.sin((dec2 - dec1) / 2) ** 2
+        + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    )
+    return np.rad2deg(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+class Cone:
+    """Cone region
+
+    Args:
+        ra, dec (float): centre in degrees
+        radius (float): radius in arcsec
+    """
+
+    def __init__(self, ra, dec, radius):
+        self.ra = ra
+        self.dec = dec
+        self.radius = radius / 3600
+
+    def overlaps(self, ra_range, dec_range, ra0):
+        """Whether the region may overlap a RA/Dec box
+
+        Args:
+            ra_range, dec_range (list): box in degrees, RA unwrapped around ra0
+            ra0 (float): RA of the field centre in degrees
+
+        Returns:
+            overlaps (boolean): the box is not entirely outside
+        """
+        ra = unwrap(self.ra, ra0)
+        ra_near = np.clip(ra, *ra_range)
+        dec_near = np.clip(self.dec, *dec_range)
+        return separation(ra, self.dec, ra_near, dec_near) <= self.radius
+
+    def contains(self, ra, dec):
+        """Whether sky positions are inside the region
+
+        Args:
+            ra, dec (array): sky positions in degrees
+
+        Returns:
+            inside (array): boolean mask
+        """
+        return separation(self.ra, self.dec, ra, dec) <= self.radius
+
+
+class Box:
+    """RA/Dec box region
+
+    Args:
+        ra_min, ra_max (float): RA range in degrees, across RA = 0 if
+                                ra_min > ra_max
+        dec_min, dec_max (float): Dec range in degrees
+    """
+
+    def __init__(self, ra_min, ra_max, dec_min, dec_max):
+        self.ra_min = ra_min
+        self.ra_width = (ra_max - ra_min) % 360
+        self.dec_min = dec_min
+        self.dec_max = dec_max
+
+    def overlaps(self, ra_range, dec_range, ra0):
+        if dec_range[1] < self.dec_min or dec_range[0] > self.dec_max:
+            return False
+        ra_min = unwrap(self.ra_min, ra0)
+        for shift in (-360, 0, 360):
+            start = ra_min + shift
+            if ra_range[1] >= start and ra_range[0] <= start + self.ra_width:
+                return True
+        return False
+
+    def contains(self, ra, dec):
+        return (
+            ((np.asarray(ra) - self.ra_min) % 360 <= self.ra_width)
+            & (dec >= self.dec_min)
+            & (dec <= self.dec_max)
+        )
+
+
+class Polygon:
+    """Polygon region, with edges straight in RA cos(Dec) and Dec
+
+    Args:
+        vertices (list): (ra, dec) of each vertex in degrees
+    """
+
+    def __init__(self, vertices):
+        vertices = np.asarray(vertices, dtype=np.float64)
+        self.ra0 = vertices[0, 0]
+        self.dec0 = np.mean(vertices[:, 1])
+        self.x, self.y = self.project(vertices[:, 0], vertices[:, 1])
+
+    def project(self, ra, dec):
+        x = (unwrap(ra, self.ra0) - self.ra0) * np.cos(np.deg2rad(self.dec0))
+        return x, np.asarray(dec, dtype=np.float64)
+
+    def overlaps(self, ra_range, dec_range, ra0):
+        x_range = self.project(np.asarray(ra_range), dec_range)[0]
+        return not (
+            x_range.max() < self.x.min()
+            or x_range.min() > self.x.max()
+            or dec_range[1] < self.y.min()
+            or dec_range[0] > self.y.max()
+        )
+
+    def contains(self, ra, dec):
+        """Even-odd rule"""
+        x, y = self.project(ra, dec)
+        inside = np.zeros(len(x), dtype=bool)
+        x1, y1 = self.x, self.y
+        x2, y2 = np.roll(self.x, -1), np.roll(self.y, -1)
+        for k in range(len(x1)):
+            if y1[k] == y2[k]:
+                continue
+            crosses = (y1[k] > y) != (y2[k] > y)
+            x_cross = x1[k] + (y - y1[k]) * (x2[k] - x1[k]) / (y2[k] - y1[k])
+            inside ^= crosses & (x < x_cross)
+        return inside
+
+
+class PartitionedCatalog:
+    """Read a catalog written by PartitionWriter
+
+    Args:
+        folder (string): catalog folder
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, index_name)) as f:
+            self.index = json.load(f)
+        self.dtype = np.dtype([tuple(j) for j in self.index["dtype"]])
+        self.ra0 = self.index["center"][0]
+
+    def select(self, region=None, mag=None, chips=None):
+        """Partitions which may contain stars of the query
+
+        Args:
+            region (Cone, Box or Polygon): sky region
+                                           (None)
+            mag (dictionary): filter name -> (faintest, brightest) magnitude
+                              (None)
+            chips (list): chip numbers
+                          (None)
+
+        Returns:
+            partitions (list): index entries
+        """
+        partitions = list()
+        for entry in self.index["partitions"]:
+            if entry["rows"] == 0:
+                continue
+            if chips is not None and entry["chip"] not in chips:
+                continue
+            if region is not None and not region.overlaps(
+                entry["ra"], entry["dec"], self.ra0
+            ):
+                continue
+            if mag is not None and any(
+                entry["mag"][name + "_VEGA"][0] > max(limits)
+                or entry["mag"][name + "_VEGA"][1] < min(limits)
+                for name, limits in mag.items()
+            ):
+                continue
+            partitions.append(entry)
+        return partitions
+
+    def read(self, entry):
+        """Memory map one partition
+
+        Args:
+            entry (dictionary): index entry
+
+        Returns:
+            records (array): memory-mapped records
+        """
+        return np.memmap(
+            os.path.join(self.folder, entry["file"]),
+            dtype=self.dtype,
+            mode="r",
+            shape=(entry["rows"],),
+        )
+
+    def query(self, region=None, mag=None, chips=None, columns=None):
+        """Stars in a region and magnitude range
+
+        Only the partitions which may overlap the query are read.
+
+        Args:
+            region (Cone, Box or Polygon): sky region
+                                           (None)
+            mag (dictionary): filter name -> (faintest, brightest) magnitude
+                              (None)
+            chips (list): chip numbers
+                          (None)
+            columns (list): column names, all the columns by default
+                            (None)
+
+        Returns:
+            t (Table): selected stars
+        """
+        if columns is None:
+            columns = list(self.dtype.names)
+        parts = list()
+        for entry in self.select(region, mag, chips):
+            records = self.read(entry)
+            good = np.ones(len(records), dtype=bool)
+            if region is not None:
+                good &= region.contains(records["RA"], records["DEC"])
+            if mag is not None:
+                for name, limits in mag.items():
+                    values = records[name + "_VEGA"]
+                    good &= (values >= min(limits)) & (values <= max(limits))
+            parts.append({name: records[name][good] for name in columns})
+        return Table(
+            [
+                (
+                    np.concatenate([j[name] for j in parts])
+                    if parts
+                    else np.zeros(0, self.dtype[name])
+                )
+                for name in columns
+            ],
+            names=columns,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-i", "--input", default="final/o.gst.part", help="Partitioned catalog"
+    )
+    parser.add_argument("-o", "--output", default="query.fits", help="Output")
+    parser.add_argument(
+        "--cone", nargs=3, type=float, help="RA, Dec in deg and radius in arcsec"
+    )
+    parser.add_argument(
+        "--box", nargs=4, type=float, help="RA min, RA max, Dec min, Dec max in deg"
+    )
+    parser.add_argument(
+        "--polygon", nargs="+", type=float, help="RA Dec of each vertex in deg"
+    )
+    parser.add_argument(
+        "--mag",
+        nargs=3,
+        action="append",
+        metavar=("FILTER", "MIN", "MAX"),
+        help="Magnitude range of a filter, may be repeated",
+    )
+    parser.add_argument("--chip", nargs="+", type=int, help="Chip numbers")
+    args = parser.parse_args()
+
+    region = None
+    if args.cone:
+        region = Cone(*args.cone)
+    elif args.box:
+        region = Box(*args.box)
+    elif args.polygon:
+        region = Polygon(np.reshape(args.polygon, (-1, 2)))
+    mag = None
+    if args.mag:
+        mag = {j[0]: (float(j[1]), float(j[2])) for j in args.mag}
+
+    cat = PartitionedCatalog(args.input)
+    partitions = cat.select(region, mag, args.chip)
+    print(
+        "Reading {0:d} of {1:d} partitions".format(
+            len(partitions), len(cat.index["partitions"])
+        )
+    )
+    t = cat.query(region, mag, args.chip)
+    print("{0:d} stars selected".format(len(t)))
+    catalog.write_fits(t, args.output)
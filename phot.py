@@ -1,9 +1,10 @@
 import os
 import sys
 import glob
+import argparse
 import subprocess
 
-from collections import Counter
+from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
@@ -12,99 +13,227 @@ import astropy.table
 from astropy import units as u, wcs
 from astropy.io import fits
 
+import cuts
+import coords
+import catalog
+import partition
+import exposures
+import instrument
+
+
+def ingest_chip(chip, columns, transform, sky_key, chunk=1000000):
+    """Ingest one chip into memory-mapped columns
+
+    The columns of output{chip} come from the binary cache, and RA and DEC
+    are computed by chunks into .npy files next to them, so the result is
+    passed back as file names instead of arrays. RA and DEC are recorded in
+    the meta of the cache with sky_key and only computed again when the key
+    or the output changes.
+
+    Args:
+        chip (int): chip number
+        columns (dictionary): column name -> column index
+        transform (function): pixel to sky transform
+        sky_key (dictionary): reference image and transform settings
+        chunk (int): number of rows per chunk
+                     (1000000)
+
+    Returns:
+        files (dictionary): column name -> .npy file, None if empty
+    """
+    data_name = "output{0:d}".format(chip)
+    with instrument.stage("open_output"):
+        data = catalog.open_output(data_name, columns)
+    rows = len(data["X"])
+    print("Loaded {0} objects from chip {1:d}".format(rows, chip))
+    if rows == 0:
+        return None
+    folder = catalog.cache_dir(data_name)
+    files = {
+        name: os.path.join(folder, "c{0:d}.npy".format(index))
+        for name, index in columns.items()
+    }
+    for name in ["RA", "DEC"]:
+        files[name] = os.path.join(folder, "{0}.npy".format(name))
+    meta = catalog.read_cache_meta(data_name)
+    if meta.get("sky") == sky_key and all(
+        os.path.exists(files[j]) for j in ["RA", "DEC"]
+    ):
+        return files
+    with instrument.stage("wcs"):
+        ra = np.lib.format.open_memmap(files["RA"] + ".tmp", "w+", np.float64, (rows,))
+        dec = np.lib.format.open_memmap(
+            files["DEC"] + ".tmp", "w+", np.float64, (rows,)
+        )
+        for start in range(0, rows, chunk):
+            end = start + chunk
+            ra[start:end], dec[start:end] = transform(
+                np.asarray(data["X"][start:end]), np.asarray(data["Y"][start:end])
+            )
+        ra.flush()
+        dec.flush()
+        del ra, dec
+        for name in ["RA", "DEC"]:
+            os.replace(files[name] + ".tmp", files[name])
+    meta["sky"] = sky_key
+    catalog.write_cache_meta(data_name, meta)
+    return files
+
+
+def load_chip(chip, files, names):
+    """Open the columns of one ingested chip
+
+    Args:
+        chip (int): chip number
+        files (dictionary): column name -> .npy file, None if empty
+        names (list): column names
+
+    Returns:
+        data (dictionary): column name -> memory-mapped array
+    """
+    if files is None:
+        return {name: np.zeros(0, catalog.column_dtype(name)) for name in names}
+    data = {k: np.load(v, mmap_mode="r") for k, v in files.items()}
+    data["chip"] = np.full(len(data["X"]), chip, dtype=catalog.column_dtype("chip"))
+    return data
+
+
 if __name__ == "__main__":
-    refname = glob.glob("*drz.fits")[0]
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--chunk",
+        type=int,
+        default=0,
+        help="Stream the catalogs by chunks of rows, 0 to load them at once (0)",
+    )
+    parser.add_argument(
+        "--wcs-tol",
+        type=float,
+        default=0,
+        help="Interpolate the WCS within this error in mas, 0 for exact (0)",
+    )
+    parser.add_argument(
+        "-c", type=int, default=os.cpu_count(), help="Number of cores (all)"
+    )
+    parser.add_argument(
+        "--partition",
+        type=float,
+        help="Also save catalogs partitioned by chip and sky cells of this size in arcsec (None)",
+    )
+    parser.add_argument(
+        "--images",
+        nargs="*",
+        metavar="QUANTITY",
+        help="Also save the per-image measurements, all or the given quantities (None)",
+    )
+    parser.add_argument("--cuts", help="JSON file of the quality cuts (None)")
+    parser.add_argument("--trace", help="Save a trace of the run to file (None)")
+    args = parser.parse_args()
+    chunk = args.chunk
+    if args.trace:
+        instrument.enable(args.trace)
 
-    global_labels = ["Number", "RA", "DEC", "X", "Y", "OBJECT_TYPE"]
-    filter_labels = ["_VEGA", "_ERR", "_SNR", "_SHARP", "_ROUND", "_CROWD", "_FLAG"]
-    formats = ["f8", "f8", "f8", "f8", "f8", "f8", "f8"]
+    refname = glob.glob("*drz.fits")[0]
 
     hdu_list = fits.open(refname)
     w = wcs.WCS(hdu_list[1].header)
+    shape = (hdu_list[1].header["NAXIS2"], hdu_list[1].header["NAXIS1"])
     chip_num = len(glob.glob("output[0-9]"))
+    processes = max(1, min(args.c, chip_num))
+    # the chips are transformed in parallel, share the cores between them
+    transform = coords.pix2world(
+        w, shape, args.wcs_tol, core=max(1, args.c // processes)
+    )
+    ref_stat = os.stat(refname)
+    sky_key = {
+        "reference": [refname, ref_stat.st_size, ref_stat.st_mtime_ns],
+        "wcs_tol": args.wcs_tol,
+    }
 
     # read filters from output.columns
-    df_column = pd.read_csv("output1.columns", names=["column"], sep="\t")
-    filters = []
-    for i in range(int((len(df_column) - 11) / 13)):
-        column = df_column.iloc[11 + 13 * i]["column"]
-        if "(" in column:
-            column_filter = column.split("(")[1].split(",")[0]  # ACS
-        else:
-            column_filter = column.split(",")[1].strip()  # WFC3
-        if column_filter not in filters:
-            filters.append(column_filter)
+    filters, filters_index = catalog.read_filters("output1.columns")
     nfilters = len(filters)
-
-    filters_index = list()
-    for filter_name in filters:
-        for i in range(len(df_column)):
-            if filter_name in df_column.iloc[i].column:
-                filters_index.append(i)
-                break
-
-    t_list = list()
-    for chip in range(1, 1 + chip_num):
-        data_name = "output{0:d}".format(chip)
-        print("Loading raw DOLPHOT file...")
-        data = np.loadtxt(data_name)
-        print("Loaded {0} objects from chip {1:d}".format(len(data), chip))
-        num = np.arange(len(data[:, 0])) + 1
-        world = w.wcs_pix2world(data[:, 2], data[:, 3], 1)
-
-        ra = world[0]
-        dec = world[1]
-        chips = np.ones_like(ra) * chip
-
-        t = astropy.table.Table()
-        t.add_column(astropy.table.Column(name="chip", data=chips))  # chip number
-        t.add_column(astropy.table.Column(name=global_labels[1], data=ra))  # RA
-        t.add_column(astropy.table.Column(name=global_labels[2], data=dec))  # DEC
-        t.add_column(astropy.table.Column(name=global_labels[3], data=data[:, 2]))  # X
-        t.add_column(astropy.table.Column(name=global_labels[4], data=data[:, 3]))  # Y
-        t.add_column(
-            astropy.table.Column(name=global_labels[5], data=data[:, 10])
-        )  # ObjType
-        cols = np.int_(np.asarray((15, 17, 19, 20, 21, 22, 23)))
-
-        # loops over number of filters, names of filters to generate output columns
-        for i in range(nfilters):
-            for j, k in enumerate(filter_labels):
-                t.add_column(
-                    astropy.table.Column(
-                        name=filters[i] + k,
-                        data=data[:, cols[j] + filters_index[i] - 11],
-                    )
-                )
-        t_list.append(t)
-
-    t = astropy.table.vstack(t_list)
-
-    t.write("o.summary.fits", overwrite=True)
-
-    snr = 5.0
-    sharp = 0.04
-    crowd = 0.5
-    objtype = 1
-    flag = 99
-
-    wgood_list = list()
-    for i in range(nfilters):
-        wgood = np.where(
-            (t[filters[i] + "_SNR"] >= snr)
-            & (t[filters[i] + "_SHARP"] ** 2 < sharp)
-            & (t[filters[i] + "_CROWD"] < crowd)
-            & (t["OBJECT_TYPE"] == objtype)
-            & (t[filters[i] + "_FLAG"] <= flag)
-        )
-        wgood_list.append(wgood[0])
-    cnt = Counter(np.concatenate(wgood_list))
-    wgood_index = [k for k, v in cnt.items() if v >= nfilters]
-
-    t1 = t[wgood_index]
-    t1.write("o.gst.fits", overwrite=True)
+    columns = catalog.phot_columns(filters, filters_index)
+
+    cut_values = cuts.read_cuts(args.cuts)
+
+    print("Loading raw DOLPHOT files...")
+    names = ["chip", "RA", "DEC"] + list(columns)
+    dtype = [(name, catalog.column_dtype(name)) for name in names]
+    chips = range(1, 1 + chip_num)
+    with instrument.stage("ingest"):
+        with Pool(processes) as p:
+            results = p.starmap(
+                ingest_chip,
+                [
+                    (chip, columns, transform, sky_key, chunk or 1000000)
+                    for chip in chips
+                ],
+            )
+    chip_data = [load_chip(chip, j, names) for chip, j in zip(chips, results)]
+
+    if chunk:
+        summary = catalog.FitsTableWriter("o.summary.fits", dtype)
+        gst = catalog.FitsTableWriter("o.gst.fits", dtype)
+        with instrument.stage("stream"):
+            for data in chip_data:
+                for start in range(0, len(data["X"]), chunk):
+                    block = {
+                        name: np.asarray(data[name][start : start + chunk])
+                        for name in names
+                    }
+                    summary.write(block)
+                    good = cuts.good_stars(block, filters, cut_values)
+                    gst.write({k: v[good] for k, v in block.items()})
+        summary.close()
+        gst.close()
+
+    else:
+        with instrument.stage("write_summary"):
+            t = astropy.table.Table(
+                [np.concatenate([j[name] for j in chip_data]) for name in names],
+                names=names,
+            )
+            catalog.write_fits(t, "o.summary.fits")
+
+        with instrument.stage("write_gst"):
+            t1 = t[cuts.good_stars(t, filters, cut_values)]
+            catalog.write_fits(t1, "o.gst.fits")
 
     if not os.path.isdir("final"):
         subprocess.call("mkdir final", shell=True)
     subprocess.call("mv o.summary.fits final", shell=True)
     subprocess.call("mv o.gst.fits final", shell=True)
+
+    if args.partition:
+        print("Saving partitioned catalogs...")
+        ra0, dec0 = transform(
+            np.array([(shape[1] + 1) / 2]), np.array([(shape[0] + 1) / 2])
+        )
+        center = (ra0[0], dec0[0])
+        with instrument.stage("partition"):
+            summary = partition.PartitionWriter(
+                "final/o.summary.part", dtype, center, args.partition
+            )
+            gst = partition.PartitionWriter(
+                "final/o.gst.part", dtype, center, args.partition
+            )
+            step = chunk or 1000000
+            for data in chip_data:
+                for start in range(0, len(data["X"]), step):
+                    block = {
+                        name: np.asarray(data[name][start : start + step])
+                        for name in names
+                    }
+                    summary.write(block)
+                    good = cuts.good_stars(block, filters, cut_values)
+                    gst.write({k: v[good] for k, v in block.items()})
+            summary.close()
+            gst.close()
+    if args.images is not None:
+        print("Saving per-image measurements...")
+        with instrument.stage("images"):
+            exposures.write_image_store(
+                "final/o.images", chip_num, args.images or None, chunk or 100000
+            )
+    instrument.finish()
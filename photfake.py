@@ -1,11 +1,14 @@
 import os
+import sys
+import json
 import glob
 import pickle
 import random
+import shutil
 import argparse
-import subprocess
 
 from multiprocessing import Pool
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
@@ -17,17 +20,32 @@ from astropy import wcs
 from astropy.io import fits
 from astropy.table import Table
 
+import cuts
+import coords
+import catalog
+import journal
+import instrument
 
-def read_fits(file_name):
+
+def read_fits(file_name, shuffle=True):
     """Read fits and sort by seed 1442291549
-    
+
+    The columns are converted to the catalog schema. The ID of each star
+    is its row in the file.
+
     Args:
         file_name (string): file name
+        shuffle (boolean): sort by seed as fake.py does
+                           (True)
 
     Returns:
         df (DataFrame): data frame
     """
     df = Table.read(file_name).to_pandas()
+    df = df.astype({k: catalog.column_dtype(k) for k in df.columns})
+    df = df.assign(ID=np.arange(len(df)))
+    if not shuffle:
+        return df
     random.seed(1442291549)
     tag = np.arange(0, len(df))
     random.shuffle(tag)
@@ -39,7 +57,7 @@ def read_fits(file_name):
 
 def get_filters(df):
     """Get filters name
-    
+
     Args:
         df (DataFrame): dataframe
 
@@ -54,19 +72,166 @@ def get_filters(df):
     return filter_list
 
 
-def add_coordinate(df, w):
+def add_coordinate(df, transform):
     """Add coordinate X and Y
-    
+
     Args:
         df (DataFrame): data frame
-        w (wcs): wcs
+        transform (function): pixel to sky transform
     """
-    world = w.wcs_pix2world(df["X"], df["Y"], 1)
+    world = transform(df["X"], df["Y"])
     df = df.assign(RA=world[0])
     df = df.assign(DEC=world[1])
     return df
 
 
+def match_positions(x, y, x_ref, y_ref, radius):
+    """Match positions to a reference list with a sorted-X join
+
+    The reference is sorted by X once and the candidates of all the
+    positions, those within radius in X, are tested together, one offset
+    at a time.
+
+    Args:
+        x, y (array): positions
+        x_ref, y_ref (array): reference positions
+        radius (float): match radius
+
+    Returns:
+        match (array): index of the first reference within radius of each
+                       position, -1 if none
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    x_ref = np.asarray(x_ref, dtype=np.float64)
+    y_ref = np.asarray(y_ref, dtype=np.float64)
+    order = np.argsort(x_ref, kind="stable")
+    x_sorted = x_ref[order]
+    low = np.searchsorted(x_sorted, x - radius, "left")
+    high = np.searchsorted(x_sorted, x + radius, "right")
+    match = np.full(len(x), -1, dtype=np.int64)
+    for offset in range(int(np.max(high - low, initial=0))):
+        k = low + offset
+        valid = k < high
+        candidate = order[np.minimum(k, len(order) - 1)]
+        distance = (x - x_ref[candidate]) ** 2 + (y - y_ref[candidate]) ** 2
+        good = valid & (distance < radius**2)
+        good &= (match < 0) | (candidate < match)
+        match[good] = candidate[good]
+    return match
+
+
+class FakeStore:
+    """Partial results of photfake.py
+
+    The block extracted from each fake output is kept in {folder}/.photfake,
+    recorded with the size and mtime of the output, so a later run only
+    extracts the new or changed outputs. The store is cleared when the
+    parameters of the extraction change.
+
+    Args:
+        folder (string): fake star folder
+        params (dictionary): parameters of the extraction
+    """
+
+    def __init__(self, folder, params):
+        self.folder = os.path.join(folder, ".photfake")
+        self.record_name = os.path.join(self.folder, "record.json")
+        self.params = json.loads(json.dumps(params))
+        self.record = None
+        if os.path.exists(self.record_name):
+            try:
+                with open(self.record_name) as f:
+                    self.record = json.load(f)
+            except ValueError:
+                print("Broken record {0}, starting over".format(self.record_name))
+        if self.record is not None and self.record["params"] != self.params:
+            print("Extraction parameters changed, starting over")
+            self.record = None
+        if self.record is None:
+            if os.path.isdir(self.folder):
+                shutil.rmtree(self.folder)
+            self.record = {"params": self.params, "outputs": dict()}
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def stat(output_name):
+        """Size and mtime of a fake output
+
+        Args:
+            output_name (string): fake output
+
+        Returns:
+            source (list): size and mtime in ns
+        """
+        file_stat = os.stat(output_name)
+        return [file_stat.st_size, file_stat.st_mtime_ns]
+
+    def is_fresh(self, output_name):
+        """Check whether a fake output is already in the store
+
+        Args:
+            output_name (string): fake output
+
+        Returns:
+            fresh (boolean): whether it can be skipped
+        """
+        entry = self.record["outputs"].get(output_name)
+        return entry is not None and entry["source"] == self.stat(output_name)
+
+    def block_name(self, output_name):
+        return os.path.join(self.folder, os.path.basename(output_name) + ".npy")
+
+    def add(self, output_name, df, source):
+        """Save the block of a fake output
+
+        Args:
+            output_name (string): fake output
+            df (DataFrame): extracted block
+            source (list): size and mtime of the output when it was read
+        """
+        block_name = self.block_name(output_name)
+        if len(df) > 0:
+            with open(block_name + ".tmp", "wb") as f:
+                np.save(f, df.to_records(index=False))
+            os.replace(block_name + ".tmp", block_name)
+        elif os.path.exists(block_name):
+            os.remove(block_name)
+        self.record["outputs"][output_name] = {"source": source, "rows": len(df)}
+
+    def forget(self, output_names):
+        """Drop the outputs which are gone
+
+        Args:
+            output_names (list): current fake outputs
+        """
+        for output_name in set(self.record["outputs"]) - set(output_names):
+            del self.record["outputs"][output_name]
+            if os.path.exists(self.block_name(output_name)):
+                os.remove(self.block_name(output_name))
+
+    def load(self, output_names):
+        """Read the blocks of fake outputs
+
+        Args:
+            output_names (list): fake outputs
+
+        Returns:
+            blocks (list): DataFrame of each output with stars
+        """
+        return [
+            pd.DataFrame(np.load(self.block_name(j)))
+            for j in output_names
+            if j in self.record["outputs"] and self.record["outputs"][j]["rows"] > 0
+        ]
+
+    def save(self):
+        """Write the record"""
+        with open(self.record_name + ".tmp", "w") as f:
+            json.dump(self.record, f)
+        os.replace(self.record_name + ".tmp", self.record_name)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -80,34 +245,62 @@ if __name__ == "__main__":
         help="Number of fake stars per run (default)",
     )
     parser.add_argument("-c", type=int, default=30, help="Number of cores (30)")
+    parser.add_argument(
+        "--wcs-tol",
+        type=float,
+        default=0,
+        help="Interpolate the WCS within this error in mas, 0 for exact (0)",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Extract all the outputs again instead of only the new ones (False)",
+    )
+    parser.add_argument("--cuts", help="JSON file of the quality cuts (None)")
+    parser.add_argument("--trace", help="Save a trace of the run to file (None)")
     args = parser.parse_args()
     folder = args.folder
     num_step = args.run
     core = args.c
+    cut_values = cuts.read_cuts(args.cuts)
     file_name = "{0}.fits".format(folder)
+    if args.trace:
+        instrument.enable(args.trace)
 
     print("Reading ...")
     refname = glob.glob("*drz.fits")[0]
     hdu_list = fits.open(refname)
     w = wcs.WCS(hdu_list[1].header)
+    shape = (hdu_list[1].header["NAXIS2"], hdu_list[1].header["NAXIS1"])
+    transform = coords.pix2world(w, shape, args.wcs_tol)
+
+    # ID -> (chip, run, row) table written by fake.py
+    ids_name = "{0}/ids.npy".format(folder)
+    fake_runs = dict()
+    if os.path.exists(ids_name):
+        fake_ids = np.load(ids_name)
+        keys = np.stack([fake_ids["chip"], fake_ids["run"]], axis=1)
+        keys, starts = np.unique(keys, axis=0, return_index=True)
+        order = np.argsort(starts)
+        keys, starts = keys[order], starts[order]
+        ends = np.append(starts[1:], len(fake_ids))
+        for key, start, end in zip(keys, starts, ends):
+            fake_runs[tuple(int(k) for k in key)] = fake_ids["id"][start:end]
+    else:
+        print("No {0}, matching the fake stars by position".format(ids_name))
 
-    df_fake = read_fits(file_name)
+    with instrument.stage("read_fits"):
+        df_fake = read_fits(file_name, shuffle=not fake_runs)
     filter_list = get_filters(df_fake)
 
     for filter in filter_list:
         filter_index = list(df_fake.columns).index("{0}_VEGA".format(filter))
         df_fake.columns.values[filter_index] = "{0}_VEGA_IN".format(filter)
 
-    df_fake = add_coordinate(df_fake, w)
+    df_fake = add_coordinate(df_fake, transform)
 
     print("Extracting ...")
-    filter_labels = ["_VEGA", "_ERR", "_SNR", "_SHARP", "_ROUND", "_CROWD", "_FLAG"]
     nimg = len(glob.glob("*flt.fits"))
-    index_array = np.array([15, 17, 19, 20, 21, 22, 23]) + 2 * (nimg + 2)
-    labels_list = list()
-    for filter in filter_list:
-        for label in filter_labels:
-            labels_list.append("{0}{1}".format(filter, label))
 
     df_column = pd.read_csv("output1.columns", names=["column"], sep="\t")
     filters_index = list()
@@ -116,71 +309,145 @@ if __name__ == "__main__":
             if filter_name in df_column.iloc[i].column:
                 filters_index.append(i)
                 break
+    output_columns = OrderedDict([("X", 2), ("Y", 3)])
+    output_columns.update(
+        catalog.phot_columns(
+            filter_list,
+            filters_index,
+            2 * (nimg + 2),
+            labels=OrderedDict([("OBJECT_TYPE", 10)]),
+        )
+    )
+    labels_list = list(output_columns)[2:]
 
     columns = list(df_fake.columns)
     columns.remove("RA")
     columns.remove("DEC")
 
-    output_names = glob.glob("{0}/output*".format(folder))
+    result_columns = labels_list + columns + ["RA", "DEC"]
 
     def inner_extract(output_name):
-        df_raw = pd.DataFrame(columns=labels_list + columns)
         if os.stat(output_name).st_size != 0:
             try:
-                data = np.loadtxt(output_name)
-            except:
-                subprocess.call("rm {0}".format(output_name), shell=True)
-                print(output_name)
+                data = catalog.read_output(output_name, output_columns)
+            except Exception as error:
+                print("Cannot read {0}: {1}".format(output_name, error))
+                return None
             else:
-                chip = int(output_name.split(".")[0][-1])
-                step = int(output_name.split("fake")[-1])
-                df_sel = df_fake[df_fake.chip == chip].iloc[
-                    num_step * step : num_step * (step + 1)
+                chip, step = journal.parse_name(output_name, journal.output_pattern)
+                if fake_runs:
+                    df_sel = df_fake.iloc[fake_runs.get((chip, step), [])]
+                else:
+                    df_sel = df_fake[df_fake.chip == chip].iloc[
+                        num_step * step : num_step * (step + 1)
+                    ]
+                match = np.arange(len(df_sel))
+                if len(df_sel) != len(data["X"]) or np.any(
+                    (data["X"] - df_sel["X"].to_numpy()) ** 2
+                    + (data["Y"] - df_sel["Y"].to_numpy()) ** 2
+                    >= 0.0002
+                ):
+                    match = match_positions(
+                        data["X"], data["Y"], df_sel["X"], df_sel["Y"], 0.0002**0.5
+                    )
+                found = match >= 0
+                if not found.all():
+                    print(
+                        "{0}: {1:d} stars not matched".format(
+                            output_name, np.sum(~found)
+                        )
+                    )
+                df_raw = df_sel.iloc[match[found]].reset_index(drop=True)
+                df_raw = df_raw.assign(
+                    **{label: np.asarray(data[label])[found] for label in labels_list}
+                )
+                return df_raw[result_columns]
+        return pd.DataFrame(columns=result_columns)
+
+    params = {
+        "fake": FakeStore.stat(file_name),
+        "reference": FakeStore.stat(refname),
+        "run": None if fake_runs else num_step,
+        "wcs_tol": args.wcs_tol,
+        "columns": output_columns,
+        "ids": FakeStore.stat(ids_name) if fake_runs else None,
+    }
+    if args.rebuild and os.path.isdir(os.path.join(folder, ".photfake")):
+        shutil.rmtree(os.path.join(folder, ".photfake"))
+    store = FakeStore(folder, params)
+    log = journal.Journal(folder)
+    output_names = sorted(
+        j
+        for j in glob.glob("{0}/output*".format(folder))
+        if journal.parse_name(j, journal.output_pattern) is not None
+    )
+    if log.exists():
+        tasks = log.read()
+        output_names = [
+            j
+            for j in output_names
+            if tasks.get(
+                journal.task_name(*journal.parse_name(j, journal.output_pattern)), {}
+            ).get("state")
+            == "done"
+        ]
+    store.forget(output_names)
+    new_names = [j for j in output_names if not store.is_fresh(j)]
+    print("{0:d} of {1:d} outputs to extract".format(len(new_names), len(output_names)))
+    sources = {j: FakeStore.stat(j) for j in new_names}
+    broken = list()
+
+    with instrument.stage("extract"):
+        try:
+            with Pool(core) as pool:
+                for output_name, df_raw in zip(
+                    new_names, pool.imap(inner_extract, new_names)
+                ):
+                    if df_raw is None:
+                        broken.append(output_name)
+                    elif sources[output_name][0] > 0 and os.path.exists(output_name):
+                        store.add(output_name, df_raw, sources[output_name])
+        finally:
+            store.save()
+        result = store.load(output_names)
+    if broken:
+        print(
+            "{0:d} outputs cannot be read, run fake.py --con to redo them".format(
+                len(broken)
+            )
+        )
+        if log.exists():
+            log.append(
+                [
+                    {
+                        "task": journal.task_name(
+                            *journal.parse_name(j, journal.output_pattern)
+                        ),
+                        "state": "failed",
+                        "error": "unreadable",
+                    }
+                    for j in broken
                 ]
-                if len(data.shape) == 1:
-                    data = [data]
-                for data_item in data:
-                    x_data = data_item[2]
-                    y_data = data_item[3]
-                    f = np.zeros(len(labels_list))
-                    for j in range(len(filter_list)):
-                        for i, index in enumerate(index_array):
-                            f[i + 7 * j] = data_item[
-                                index + filters_index[j] - 11
-                            ]  # BUG
-                    data_series = pd.Series(f, index=labels_list)
-                    item = df_sel[
-                        (x_data - df_sel["X"]) ** 2 + (y_data - df_sel["Y"]) ** 2
-                        < 0.0002
-                    ].iloc[0]
-                    df_raw = df_raw.append(item.append(data_series), ignore_index=True)
-                return df_raw
-
-    pool = Pool(core)
-    result = pool.map(inner_extract, output_names)
-    pool.close()
+            )
+        else:
+            # without a journal, fake.py --con reruns the missing outputs
+            for j in broken:
+                os.replace(j, j + ".broken")
 
+    if not result:
+        # e.g. early in a campaign, before any run is done
+        print("No fake stars are extracted yet, nothing is saved")
+        instrument.finish()
+        sys.exit(1)
     df = pd.concat(result)
     df.reset_index(drop=True, inplace=True)
 
     print("Selecting ...")
-    snr = 5
-    sharp = 0.04
-    crowd = 0.5
-    flag = np.zeros(len(df))
-
-    index = (df["X"] >= 0).all()
-    for filter in filter_list:
-        index = (
-            index
-            & (df["{0}_SNR".format(filter)] > snr)
-            & (df["{0}_SHARP".format(filter)] ** 2 < sharp)
-            & (df["{0}_CROWD".format(filter)] < crowd)
-        )
-
-    df = df.assign(flag=index.values)
+    df = df.assign(flag=cuts.good_stars(df, filter_list, cut_values))
 
     print("Saving ...")
 
-    t = Table.from_pandas(df)
-    t.write("final/f.{0}.fits".format(folder), overwrite=True)
+    with instrument.stage("save"):
+        t = Table.from_pandas(df)
+        catalog.write_fits(t, "final/f.{0}.fits".format(folder))
+    instrument.finish()
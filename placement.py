@@ -0,0 +1,100 @@
+import re
+
+import numpy as np
+
+rpsf_pattern = re.compile(r"^\s*img\d*_rpsf\s*=\s*(\S+)", re.IGNORECASE)
+
+
+def read_rpsf(param_name, default=None):
+    """Read the largest PSF radius from a DOLPHOT parameter file
+
+    Args:
+        param_name (string): parameter file
+        default (float): value if no imgN_RPSF is set
+                         (None)
+
+    Returns:
+        rpsf (float): PSF radius in pixels
+    """
+    values = list()
+    with open(param_name) as f:
+        for line in f:
+            match = rpsf_pattern.match(line)
+            if match is not None:
+                values.append(float(match.group(1)))
+    if not values:
+        return default
+    return max(values)
+
+
+def stratified_xy(num, xlim, ylim, rng=np.random):
+    """Random positions spread evenly over a rectangle
+
+    The rectangle is cut into about num cells of the same shape and every
+    position falls uniformly in a different cell, drawn at random, so the
+    positions cover the rectangle without the clumps of pure random ones.
+
+    Args:
+        num (int): number of positions
+        xlim (tuple): (xmin, xmax)
+        ylim (tuple): (ymin, ymax)
+        rng (RandomState or Generator): random generator
+                                        (np.random)
+
+    Returns:
+        x, y (array): positions
+    """
+    width = xlim[1] - xlim[0]
+    height = ylim[1] - ylim[0]
+    if num == 0 or width <= 0 or height <= 0:
+        return rng.uniform(*xlim, num), rng.uniform(*ylim, num)
+    nx = max(1, int(np.ceil(np.sqrt(num * width / height))))
+    ny = max(1, int(np.ceil(num / nx)))
+    cell = rng.permutation(nx * ny)[:num]
+    x = xlim[0] + (cell % nx + rng.uniform(0, 1, num)) * (width / nx)
+    y = ylim[0] + (cell // nx + rng.uniform(0, 1, num)) * (height / ny)
+    return x, y
+
+
+def pack_runs(x, y, separation, run):
+    """Split fake stars into runs whose stars do not interfere
+
+    The stars are hashed into square cells with the separation as side.
+    Cells whose indices have the same parity in x and in y are at least two
+    cells apart, so the stars in different cells of such a class are at
+    least the separation apart. A run takes the n-th star of every cell of
+    one parity class, in the given order, cut into runs of at most run
+    stars.
+
+    Args:
+        x, y (array): positions in pixels
+        separation (float): smallest distance between the stars of a run
+        run (int): largest number of stars per run
+
+    Returns:
+        runs (list): index arrays of the stars of each run
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if len(x) == 0:
+        return list()
+    i = np.floor((x - x.min()) / separation).astype(np.int64)
+    j = np.floor((y - y.min()) / separation).astype(np.int64)
+    cell = j * (i.max() + 1) + i
+    # rank of each star within its cell, keeping the given order
+    order = np.argsort(cell, kind="stable")
+    sorted_cell = cell[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cell[1:] != sorted_cell[:-1]])
+    counts = np.diff(np.r_[starts, len(order)])
+    rank = np.empty(len(x), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(starts, counts)
+    group = rank * 4 + (i % 2) * 2 + j % 2
+    order = np.argsort(group, kind="stable")
+    sorted_group = group[order]
+    starts = np.flatnonzero(np.r_[True, sorted_group[1:] != sorted_group[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    runs = list()
+    for start, end in zip(starts, ends):
+        for k in range(start, end, run):
+            runs.append(order[k : min(k + run, end)])
+    return runs
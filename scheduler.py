@@ -0,0 +1,201 @@
+import os
+import re
+import time
+import subprocess
+
+from collections import OrderedDict, deque
+
+from astropy.io import fits
+
+import instrument
+
+file_pattern = re.compile(r"^\s*img\d+_file\s*=\s*(\S+)", re.IGNORECASE)
+
+
+def param_images(param_name):
+    """Read the image names of a DOLPHOT parameter file
+
+    Args:
+        param_name (string): parameter file
+
+    Returns:
+        images (list): image names without .fits, the reference included
+    """
+    images = list()
+    with open(param_name) as f:
+        for line in f:
+            match = file_pattern.match(line)
+            if match is not None:
+                images.append(match.group(1))
+    return images
+
+
+def estimate_rss(param_name, planes=3, overhead=64 * 2**20):
+    """Estimate the peak RSS of DOLPHOT from its images
+
+    DOLPHOT holds every image of the chip in memory as float32, together
+    with its sky and its residual, hence planes pixel arrays per image.
+    The size is read from the FITS header, or from the file if unreadable.
+
+    Args:
+        param_name (string): parameter file
+        planes (int): arrays of each image in memory
+                      (3)
+        overhead (int): memory of the program itself in bytes
+                        (64 MB)
+
+    Returns:
+        rss (int): estimated peak RSS in bytes
+    """
+    rss = overhead
+    for image in param_images(param_name):
+        file_name = "{0}.fits".format(image)
+        try:
+            header = fits.getheader(file_name)
+            rss += planes * 4 * header["NAXIS1"] * header["NAXIS2"]
+        except (OSError, KeyError):
+            if os.path.exists(file_name):
+                rss += planes * os.path.getsize(file_name)
+    return rss
+
+
+class MemoryScheduler:
+    """Run external tasks in parallel within a memory budget
+
+    A task is started only while the estimated peak RSS of all the running
+    tasks, itself included, stays under the budget, and there are fewer
+    than workers of them. A task larger than the whole budget runs alone.
+    Each task belongs to a group, e.g. a chip, whose estimate starts from
+    the given one and is replaced by the largest peak RSS measured in the
+    group times margin as soon as one of its tasks finishes.
+
+    Args:
+        workers (int): largest number of running tasks
+        budget (int): memory budget in bytes, None for no limit
+        estimates (dictionary): group -> initial peak RSS estimate in bytes
+        margin (float): factor applied to the measured peaks
+                        (1.2)
+    """
+
+    def __init__(self, workers, budget, estimates, margin=1.2):
+        self.workers = max(1, workers)
+        self.budget = budget
+        self.estimates = dict(estimates)
+        self.peaks = dict()
+        self.margin = margin
+        self.running = OrderedDict()
+
+    def used(self):
+        return sum(self.estimates[j[0][0]] for j in self.running.values())
+
+    def admit(self, group):
+        """Whether a task of group can start now"""
+        if len(self.running) >= self.workers:
+            return False
+        if self.budget is None or not self.running:
+            return True
+        return self.used() + self.estimates[group] <= self.budget
+
+    def start(self, task):
+        group, key, args, name, kwargs = task
+        kwargs = dict(kwargs)
+        log_name = kwargs.pop("log", None)
+        if log_name is None:
+            proc = subprocess.Popen(args, **kwargs)
+        else:
+            with open(log_name, "w") as log:
+                proc = subprocess.Popen(
+                    args, stdout=log, stderr=subprocess.STDOUT, **kwargs
+                )
+        self.running[proc.pid] = (task, time.time(), proc)
+
+    def wait(self, interval=0.05):
+        """Wait for one running task
+
+        Only the tasks started here are waited for, so the other children of
+        the process are left alone.
+
+        Args:
+            interval (float): time between two polls in seconds
+                              (0.05)
+
+        Returns:
+            task (tuple): the finished task
+            code (int): exit status
+            wall (float): wall time in seconds
+            rss (int): peak RSS in bytes
+        """
+        pid = 0
+        while pid == 0:
+            for j in self.running:
+                pid, status, usage = os.wait4(j, os.WNOHANG)
+                if pid != 0:
+                    break
+            else:
+                time.sleep(interval)
+        task, start, proc = self.running.pop(pid)
+        wall = time.time() - start
+        code = os.waitstatus_to_exitcode(status)
+        proc.returncode = code
+        rss = usage.ru_maxrss * 1024
+        group, key, args, name, _ = task
+        self.peaks[group] = max(self.peaks.get(group, 0), rss)
+        self.estimates[group] = int(self.peaks[group] * self.margin)
+        if instrument.enabled():
+            instrument.record(
+                name,
+                "tool",
+                start,
+                wall,
+                {
+                    "cmd": " ".join(map(str, args)),
+                    "cpu": usage.ru_utime + usage.ru_stime,
+                    "rss": rss,
+                    "exit": code,
+                    "read": 0,
+                    "write": 0,
+                },
+            )
+        return task, code, wall, rss
+
+    def run(self, tasks, started=None):
+        """Run the tasks, in order within each group
+
+        When the next task of a group does not fit, a task of another group
+        which does may start first.
+
+        Args:
+            tasks (list): (group, key, args, name, kwargs) of each task, where
+                          key identifies the task for the caller, name is the
+                          name in the trace, and args and kwargs are passed
+                          to subprocess.Popen, except log, a file which then
+                          receives the output of the task
+            started (function): called with each task before it starts
+                                (None)
+
+        Yields:
+            task, code, wall, rss: each finished task, as from wait
+        """
+        pending = OrderedDict()
+        for task in tasks:
+            pending.setdefault(task[0], deque()).append(task)
+        while pending or self.running:
+            for group in list(pending):
+                while pending[group] and self.admit(group):
+                    if not self.running and self.over_budget(group):
+                        print(
+                            "Tasks of {0} need about {1:.0f} MB, run alone".format(
+                                group, self.estimates[group] / 2**20
+                            )
+                        )
+                    task = pending[group].popleft()
+                    if started is not None:
+                        started(task)
+                    self.start(task)
+                if not pending[group]:
+                    del pending[group]
+            if self.running:
+                yield self.wait()
+
+    def over_budget(self, group):
+        return self.budget is not None and self.estimates[group] > self.budget